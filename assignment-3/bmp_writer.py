@@ -9,6 +9,17 @@ def write_bmp(bit_depth, filename):
     """
     Curried function that returns a writer which consumes a row generator
     and writes a BMP file.
+    
+    Note: Tagging the returned writer with
+    img_utils.pipeline_utils.describe_writer lets the pipeline see what it
+    writes (e.g. to stream raw 24-bit rows straight through).
+    
+    For large 8-bit exports, write_8bit_bmp_streaming is a bounded-memory
+    alternative to write_8bit_bmp that spills rows to a temporary file.
+    Both accept palette=... to reuse one palette across a batch (see
+    img_utils.palette_utils).
+    Passing grayscale=gray_hint(metadata) (img_utils.row_utils) lets them
+    skip palette work for a gray stream; every row is still checked.
       
     Args:
         bit_depth: Output bit depth (8 for indexed, 24 for RGB)
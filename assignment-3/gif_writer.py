@@ -3,14 +3,18 @@ GIF Writer Module
 Writes GIF files from a generator yielding metadata and rows of RGB tuples.
 Uses PIL/Pillow library for GIF encoding, which handles color quantization automatically.
 
-Note: Unlike BMP writer which can stream, GIF requires buffering the entire
-image due to LZW compression requirements.
+Note: convert_to_gif buffers the entire image so Pillow can pick a palette.
+With a fixed or pre-estimated palette, img_utils.gif_utils.write_gif_streaming
+encodes rows as they arrive and does not need Pillow.
 """
 
 def write_gif(filename):
     """
     Curried function that returns a writer which consumes a row generator
     and writes a GIF file.
+    
+    Note: This writes a single frame. To combine several row streams into an
+    animated GIF, see img_utils.gif_utils.write_animated_gif.
       
     Args:
         filename: Path to output GIF file  
@@ -0,0 +1,196 @@
+"""
+Async Utility Functions
+Asyncio counterparts of the reader, transformations, writers and pipeline.
+
+The pipeline itself stays synchronous: readers, transformations and writers
+are ordinary generators and functions. The async layer drives them from an
+executor in batches of rows, so the event loop never blocks on file I/O or
+pixel work, and each stream has at most two batches in flight (one being
+consumed, one being produced).
+
+A stream that is only passed from aread_bmp through atransform to awrite
+never needs a thread to wait on another: the stages are chained as plain
+generators and the whole chain is advanced in one executor call. The
+executor's worker count therefore bounds how many jobs do CPU work at once,
+while any number of jobs can be waiting on the event loop.
+"""
+
+import asyncio
+from itertools import islice
+
+from img_utils.pipeline_utils import execute_planned
+from img_utils.stream_utils import read_bmp_stream
+
+# Rows fetched per executor call by AsyncRowStream
+DEFAULT_BATCH_ROWS = 64
+
+
+class AsyncRowStream:
+    """
+    Async iterator over a synchronous row generator.
+
+    Follows the usual protocol (metadata first, then rows) with async for.
+    Rows are produced by running the generator in an executor, batch_rows
+    at a time; the next batch is requested as soon as the previous one
+    arrives, so production overlaps with consumption.
+    """
+
+    def __init__(self, row_generator, executor=None, batch_rows=DEFAULT_BATCH_ROWS):
+        """
+        Initialize async row stream.
+
+        Args:
+            row_generator: Synchronous generator yielding metadata, then rows
+            executor: concurrent.futures executor (None for the loop's default)
+            batch_rows: Rows produced per executor call
+        """
+        self.source = row_generator
+        self.executor = executor
+        self.batch_rows = batch_rows
+        self._batch = iter(())
+        self._pending = None
+        self._exhausted = False
+        self.started = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self.started = True
+        while True:
+            for item in self._batch:
+                return item
+            if self._exhausted:
+                raise StopAsyncIteration
+            if self._pending is None:
+                self._pending = self._fetch()
+            batch = await self._pending
+            self._pending = None
+            if len(batch) < self.batch_rows:
+                self._exhausted = True
+            else:
+                self._pending = self._fetch()  # Prefetch the next batch
+            self._batch = iter(batch)
+
+    def _fetch(self):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, _next_batch, self.source, self.batch_rows)
+
+    async def aclose(self):
+        """Wait for any prefetch in flight and close the source generator."""
+        if self._pending is not None:
+            await asyncio.gather(self._pending, return_exceptions=True)
+            self._pending = None
+        self._exhausted = True
+        close = getattr(self.source, 'close', None)
+        if close is not None:
+            close()
+
+
+def _next_batch(row_generator, count):
+    """Pull up to count items from a generator (runs in the executor)."""
+    return list(islice(row_generator, count))
+
+
+async def aread_bmp(filename, executor=None, batch_rows=DEFAULT_BATCH_ROWS):
+    """
+    Open a BMP file as an AsyncRowStream.
+
+    The headers are read in the executor, and so is every later batch of
+    rows (see read_bmp_stream).
+
+    Args:
+        filename: Path to BMP file
+        executor: concurrent.futures executor (None for the loop's default)
+        batch_rows: Rows decoded per executor call
+
+    Returns:
+        AsyncRowStream yielding metadata, then rows
+
+    Usage:
+        stream = await aread_bmp('photo.bmp')
+        async for item in stream:
+            ...
+    """
+    loop = asyncio.get_running_loop()
+    row_generator = await loop.run_in_executor(executor, read_bmp_stream, filename)
+    return AsyncRowStream(row_generator, executor, batch_rows)
+
+
+def atransform(transform):
+    """
+    Wrap a synchronous transformation for AsyncRowStreams.
+
+    The transformation is chained onto the stream's generator, so it runs
+    in the same executor calls that produce the rows.
+
+    Args:
+        transform: Transformation function (row generator -> row generator)
+
+    Returns:
+        Function AsyncRowStream -> AsyncRowStream
+
+    Raises:
+        TypeError: If given something other than an AsyncRowStream
+        RuntimeError: If the stream has already been iterated
+
+    Usage:
+        stream = atransform(grayscale)(await aread_bmp('photo.bmp'))
+    """
+    def apply(stream):
+        _check_unstarted(stream)
+        return AsyncRowStream(transform(stream.source), stream.executor, stream.batch_rows)
+
+    return apply
+
+
+async def awrite(image_writer, stream):
+    """
+    Consume an AsyncRowStream with a synchronous writer, off the event loop.
+
+    The writer runs in the stream's executor and pulls rows straight from
+    the generator chain, so encoding and file writes never block the loop.
+
+    Args:
+        image_writer: Writer function (e.g. write_bmp(24, 'out.bmp'))
+        stream: Unstarted AsyncRowStream
+
+    Returns:
+        Whatever image_writer returns
+    """
+    _check_unstarted(stream)
+    stream.started = True
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(stream.executor, image_writer, stream.source)
+
+
+async def arun_pipeline(input_filename, transformations, image_writer, executor=None):
+    """
+    Async counterpart of execute_transformation_pipeline.
+
+    Plans and runs the pipeline (see execute_planned) in the executor.
+
+    Args:
+        input_filename: Path to BMP file
+        transformations: List of transformation functions
+        image_writer: Writer function
+        executor: concurrent.futures executor (None for the loop's default)
+
+    Returns:
+        Whatever image_writer returns
+
+    Usage:
+        await asyncio.gather(*(arun_pipeline(name, [grayscale], write_bmp(8, name + '.out'))
+                               for name in uploaded_files))
+    """
+    loop = asyncio.get_running_loop()
+    row_generator = await loop.run_in_executor(executor, read_bmp_stream, input_filename)
+    return await loop.run_in_executor(executor, execute_planned, row_generator,
+                                      transformations, image_writer)
+
+
+def _check_unstarted(stream):
+    if not isinstance(stream, AsyncRowStream):
+        raise TypeError("Expected an AsyncRowStream, got %s" % type(stream).__name__)
+    if stream.started:
+        raise RuntimeError("Rows have already been read from this stream")
@@ -0,0 +1,158 @@
+"""
+Batch Utility Functions
+Runs one pipeline over many input files on a worker pool.
+
+The pipeline is given as a curried processing function taking
+(input_filename, image_writer), which is exactly what with_transforms
+returns, so existing helpers can be batched without changes.
+"""
+
+import glob
+import multiprocessing
+import os
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+)
+
+# Per-process state set up by _init_worker
+_worker = {}
+
+
+class BatchResult:
+    """
+    Outcome of a batch run: per-job errors plus throughput figures.
+
+    Jobs are identified by their position in the job list, since the same
+    input may feed several writers. succeeded holds the input filename of
+    each job that finished, errors maps a failed job's index to its
+    (input_filename, exception), and input_bytes counts each distinct
+    successful input once.
+    """
+
+    def __init__(self):
+        self.succeeded = []
+        self.errors = {}
+        self.input_bytes = 0
+        self.elapsed = 0.0
+
+    @property
+    def images(self):
+        """Number of jobs that were processed without error."""
+        return len(self.succeeded)
+
+    @property
+    def images_per_second(self):
+        return self.images / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def megabytes_per_second(self):
+        return self.input_bytes / 1e6 / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        """One-line report of the batch run."""
+        return ('%d images in %.2fs (%.1f images/s, %.1f MB/s), %d failed'
+                % (self.images, self.elapsed, self.images_per_second,
+                   self.megabytes_per_second, len(self.errors)))
+
+    def __str__(self):
+        return self.summary()
+
+
+def process_batch(process, jobs, make_writer=None, workers=4, max_pending=None,
+                  use_processes=False):
+    """
+    Run a processing function over many files concurrently.
+
+    A failure in one job does not stop the batch; the exception is recorded
+    in the result's errors under the job's index and the remaining jobs are
+    processed. At most
+    max_pending jobs are submitted ahead of the workers, so huge job lists
+    are consumed lazily instead of being queued all at once.
+
+    Args:
+        process: Function (input_filename, image_writer), e.g. the result of
+            with_transforms([...])
+        jobs: Either a glob pattern (make_writer is then required) or an
+            iterable of (input_filename, image_writer) pairs
+        make_writer: Function input_filename -> image_writer, used with a glob
+        workers: Number of concurrent workers
+        max_pending: Maximum number of submitted, unfinished jobs
+            (defaults to twice the number of workers)
+        use_processes: Use worker processes instead of threads for CPU-bound
+            pipelines (jobs are then collected into a list up front and
+            workers are forked, so curried writers need not be picklable)
+
+    Returns:
+        BatchResult with succeeded inputs, per-job errors and throughput
+
+    Usage:
+        def output_for(input_filename):
+            return write_bmp(24, input_filename.replace('input', 'output'))
+
+        enhance = with_transforms([brightness(1.2), flip_vertical])
+        result = process_batch(enhance, './input/*.bmp', output_for, workers=8)
+        print(result)
+    """
+    if isinstance(jobs, str):
+        if make_writer is None:
+            raise ValueError("make_writer is required when jobs is a glob pattern")
+        jobs = ((name, make_writer(name)) for name in sorted(glob.iglob(jobs)))
+    max_pending = max_pending or workers * 2
+
+    result = BatchResult()
+    start = time.perf_counter()
+
+    if use_processes:
+        jobs = list(jobs)
+        context = None
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                       initializer=_init_worker, initargs=(process, jobs))
+        tasks = (((index, name), (_run_indexed_job, index))
+                 for index, (name, writer) in enumerate(jobs))
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        tasks = (((index, name), (process, name, writer))
+                 for index, (name, writer) in enumerate(jobs))
+
+    with executor:
+        pending = {}
+        for job, call in tasks:
+            if len(pending) >= max_pending:
+                _collect(wait(pending, return_when=FIRST_COMPLETED).done, pending, result)
+            pending[executor.submit(*call)] = job
+        _collect(wait(pending).done, pending, result)
+
+    result.elapsed = time.perf_counter() - start
+    for name in set(result.succeeded):
+        try:
+            result.input_bytes += os.path.getsize(name)
+        except OSError:
+            pass
+    return result
+
+
+def _collect(done, pending, result):
+    """Record finished futures in the batch result."""
+    for future in done:
+        index, name = pending.pop(future)
+        try:
+            future.result()
+        except Exception as exc:
+            result.errors[index] = (name, exc)
+        else:
+            result.succeeded.append(name)
+
+
+def _init_worker(process, jobs):
+    """Keep the processing function and job list in each worker process."""
+    _worker['process'] = process
+    _worker['jobs'] = jobs
+
+
+def _run_indexed_job(index):
+    """Run one job from the worker's job list."""
+    name, writer = _worker['jobs'][index]
+    _worker['process'](name, writer)
@@ -3,7 +3,19 @@ BMP Reader Utility Functions
 Helper functions for reading and parsing BMP file structures.
 """
 
+import mmap
 import struct
+import tempfile
+
+from img_utils.row_utils import PackedRow
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Optional: enables bulk block decoding in parse_rows
+
+# Target size of one bulk read in BMPRowReader.read_rows
+ROW_BLOCK_BYTES = 64 * 1024
 
 
 def read_bmp_headers(f):
@@ -82,19 +94,23 @@ def calculate_row_size(width, bit_depth):
     return int((bit_depth * width + 31) / 32) * 4
 
 
-def parse_row(row_data, width, bit_depth, color_table):
+def parse_row(row_data, width, bit_depth, color_table, packed=False):
     """
     Parse a single row of pixel data into RGB tuples.
     
     Args:
-        row_data: Raw bytes for the row
+        row_data: Raw bytes for the row (bytes, bytearray or memoryview)
         width: Number of pixels in the row
         bit_depth: Bits per pixel
         color_table: Color palette for indexed formats (or None)
+        packed: Return a compact PackedRow instead of a list of tuples
         
     Returns:
-        List of (R, G, B) tuples
+        List of (R, G, B) tuples, or a PackedRow if packed is True
     """
+    if packed:
+        return _parse_packed_row(row_data, width, bit_depth, color_table)
+    
     pixels = []
     
     if bit_depth == 1:
@@ -113,71 +129,148 @@ def parse_row(row_data, width, bit_depth, color_table):
     return pixels
 
 
+def parse_rows(block_data, width, bit_depth, color_table, row_size, packed=False):
+    """
+    Parse a block of consecutive padded rows into lists of RGB tuples.
+    
+    Decodes the whole block without per-pixel struct calls: rows are read
+    through strided memoryview slices, and when NumPy is installed the
+    bit-packed and 16-bit formats are unpacked for the whole block at once.
+    Output is identical to calling parse_row on each row.
+    
+    Args:
+        block_data: Raw bytes holding one or more complete padded rows
+        width: Number of pixels in each row
+        bit_depth: Bits per pixel
+        color_table: Color palette for indexed formats (or None)
+        row_size: Row size in bytes (including padding)
+        packed: Return compact PackedRows instead of lists of tuples
+        
+    Returns:
+        List of rows, each a list of (R, G, B) tuples (or a PackedRow), in
+        block order
+    """
+    num_rows = len(block_data) // row_size
+    if num_rows == 0:
+        return []
+    
+    if np is not None and not packed and bit_depth in _NUMPY_DECODERS:
+        return _NUMPY_DECODERS[bit_depth](block_data, num_rows, width,
+                                          color_table, row_size)
+    
+    view = memoryview(block_data)
+    return [parse_row(view[i * row_size:(i + 1) * row_size], width, bit_depth,
+                      color_table, packed)
+            for i in range(num_rows)]
+
+
+# Palette indices packed into one byte, precomputed for every byte value
+_1BIT_INDICES = [tuple((byte >> (7 - bit)) & 1 for bit in range(8)) for byte in range(256)]
+_4BIT_INDICES = [((byte >> 4) & 0x0F, byte & 0x0F) for byte in range(256)]
+
+
 def _parse_1bit_row(row_data, width, color_table):
     """Parse 1-bit indexed row (8 pixels per byte)."""
-    pixels = []
-    for byte_idx in range((width + 7) // 8):
-        byte = row_data[byte_idx]
-        for bit_idx in range(8):
-            if byte_idx * 8 + bit_idx >= width:
-                break
-            pixel_idx = (byte >> (7 - bit_idx)) & 1
-            pixels.append(color_table[pixel_idx])
-    return pixels
+    indices = []
+    for byte in row_data[:(width + 7) // 8]:
+        indices.extend(_1BIT_INDICES[byte])
+    return list(map(color_table.__getitem__, indices[:width]))
 
 
 def _parse_4bit_row(row_data, width, color_table):
     """Parse 4-bit indexed row (2 pixels per byte)."""
-    pixels = []
-    for byte_idx in range((width + 1) // 2):
-        byte = row_data[byte_idx]
-        # High nibble
-        pixel_idx = (byte >> 4) & 0x0F
-        pixels.append(color_table[pixel_idx])
-        # Low nibble
-        if byte_idx * 2 + 1 < width:
-            pixel_idx = byte & 0x0F
-            pixels.append(color_table[pixel_idx])
-    return pixels
+    indices = []
+    for byte in row_data[:(width + 1) // 2]:
+        indices.extend(_4BIT_INDICES[byte])  # High nibble first
+    return list(map(color_table.__getitem__, indices[:width]))
 
 
 def _parse_8bit_row(row_data, width, color_table):
     """Parse 8-bit indexed row (1 pixel per byte)."""
-    pixels = []
-    for i in range(width):
-        pixel_idx = row_data[i]
-        pixels.append(color_table[pixel_idx])
-    return pixels
+    return list(map(color_table.__getitem__, row_data[:width]))
 
 
 def _parse_16bit_row(row_data, width):
     """Parse 16-bit RGB555 row."""
-    pixels = []
-    for i in range(width):
-        word = struct.unpack('<H', row_data[i*2:i*2+2])[0]
-        r = ((word >> 10) & 0x1F) << 3  # Scale 5-bit to 8-bit
-        g = ((word >> 5) & 0x1F) << 3
-        b = (word & 0x1F) << 3
-        pixels.append((r, g, b))
-    return pixels
+    words = struct.unpack('<%dH' % width, row_data[:width * 2])
+    # Scale each 5-bit channel to 8-bit
+    return [(((word >> 10) & 0x1F) << 3, ((word >> 5) & 0x1F) << 3, (word & 0x1F) << 3)
+            for word in words]
 
 
 def _parse_24bit_row(row_data, width):
     """Parse 24-bit BGR row."""
-    pixels = []
-    for i in range(width):
-        b, g, r = struct.unpack('BBB', row_data[i*3:i*3+3])
-        pixels.append((r, g, b))
-    return pixels
+    end = width * 3
+    return list(zip(row_data[2:end:3], row_data[1:end:3], row_data[0:end:3]))
 
 
 def _parse_32bit_row(row_data, width):
     """Parse 32-bit BGRA row (ignoring alpha)."""
-    pixels = []
-    for i in range(width):
-        b, g, r, a = struct.unpack('BBBB', row_data[i*4:i*4+4])
-        pixels.append((r, g, b))
-    return pixels
+    end = width * 4
+    return list(zip(row_data[2:end:4], row_data[1:end:4], row_data[0:end:4]))
+
+
+def _parse_packed_row(row_data, width, bit_depth, color_table):
+    """Parse a row straight into a PackedRow without building tuples where possible."""
+    if bit_depth == 24:
+        return PackedRow.from_bgr(row_data[:width * 3])
+    if bit_depth == 32:
+        end = width * 4
+        rgb = bytearray(width * 3)
+        rgb[0::3] = bytes(row_data[2:end:4])
+        rgb[1::3] = bytes(row_data[1:end:4])
+        rgb[2::3] = bytes(row_data[0:end:4])
+        return PackedRow(rgb)
+    return PackedRow.from_pixels(parse_row(row_data, width, bit_depth, color_table))
+
+
+def _np_block(block_data, num_rows, row_size, row_bytes):
+    """View a block of padded rows as a (num_rows, row_bytes) uint8 array."""
+    data = np.frombuffer(block_data, dtype=np.uint8, count=num_rows * row_size)
+    return data.reshape(num_rows, row_size)[:, :row_bytes]
+
+
+def _np_indexed_rows(indices, color_table):
+    """Map a 2-D array of palette indices to rows of palette tuples."""
+    lookup = color_table.__getitem__
+    return [list(map(lookup, row)) for row in indices.tolist()]
+
+
+def _np_rgb_rows(r, g, b):
+    """Zip three 2-D channel arrays into rows of (R, G, B) tuples."""
+    return [list(zip(r_row, g_row, b_row))
+            for r_row, g_row, b_row in zip(r.tolist(), g.tolist(), b.tolist())]
+
+
+def _np_parse_1bit(block_data, num_rows, width, color_table, row_size):
+    """NumPy decoder for 1-bit indexed blocks."""
+    block = _np_block(block_data, num_rows, row_size, (width + 7) // 8)
+    return _np_indexed_rows(np.unpackbits(block, axis=1)[:, :width], color_table)
+
+
+def _np_parse_4bit(block_data, num_rows, width, color_table, row_size):
+    """NumPy decoder for 4-bit indexed blocks."""
+    block = _np_block(block_data, num_rows, row_size, (width + 1) // 2)
+    nibbles = np.stack((block >> 4, block & 0x0F), axis=-1).reshape(num_rows, -1)
+    return _np_indexed_rows(nibbles[:, :width], color_table)
+
+
+def _np_parse_16bit(block_data, num_rows, width, color_table, row_size):
+    """NumPy decoder for 16-bit RGB555 blocks."""
+    block = _np_block(block_data, num_rows, row_size, width * 2)
+    words = block.copy().view('<u2')
+    return _np_rgb_rows(((words >> 10) & 0x1F) << 3,
+                        ((words >> 5) & 0x1F) << 3,
+                        (words & 0x1F) << 3)
+
+
+# Depths where NumPy beats the strided-slice decoders (8/24/32-bit rows are
+# already decoded in bulk by zipping memoryview slices)
+_NUMPY_DECODERS = {
+    1: _np_parse_1bit,
+    4: _np_parse_4bit,
+    16: _np_parse_16bit,
+}
 
 
 def get_next_row(f, width, bit_depth, color_table, row_size):
@@ -201,10 +294,82 @@ def get_next_row(f, width, bit_depth, color_table, row_size):
     return parse_row(row_data, width, bit_depth, color_table)
 
 
+def read_raw_blocks(f, height, row_size):
+    """
+    Generator that reads raw padded rows in blocks without decoding them.
+    
+    A single buffer of about ROW_BLOCK_BYTES is filled with readinto() and
+    reused for every block, so each yielded view is only valid until the
+    next block is requested.
+    
+    Args:
+        f: File object positioned at start of pixel data
+        height: Number of rows to read
+        row_size: Row size in bytes (including padding)
+        
+    Yields:
+        memoryview holding one or more complete padded rows
+        
+    Raises:
+        ValueError: If the file ends before all rows are read
+    """
+    rows_per_block = max(1, ROW_BLOCK_BYTES // row_size)
+    buffer = memoryview(bytearray(min(rows_per_block, max(height, 1)) * row_size))
+    remaining = height
+    while remaining > 0:
+        size = min(rows_per_block, remaining) * row_size
+        block = buffer[:size]
+        filled = 0
+        while filled < size:
+            count = f.readinto(block[filled:])
+            if not count:
+                raise ValueError("BMP pixel data is truncated")
+            filled += count
+        remaining -= size // row_size
+        yield block
+
+
+def read_rows_backwards(f, start, height, width, bit_depth, color_table, row_size,
+                        packed=False):
+    """
+    Generator that reads rows from a seekable file in reverse order.
+    
+    Rows are read in blocks of about ROW_BLOCK_BYTES, seeking backwards from
+    the end of the pixel data, so only one block is held in memory at a time.
+    Rows missing from a truncated file are skipped.
+    
+    Args:
+        f: Seekable file object opened in binary read mode
+        start: File offset of the first row
+        height: Number of rows stored from start
+        width: Image width in pixels
+        bit_depth: Bits per pixel
+        color_table: Color palette for indexed formats (or None)
+        row_size: Row size in bytes (including padding)
+        packed: Yield compact PackedRows instead of lists of tuples
+        
+    Yields:
+        List of (R, G, B) tuples (or a PackedRow) for each row, last row first
+    """
+    available = (f.seek(0, 2) - start) // row_size
+    end = max(0, min(height, available))
+    rows_per_block = max(1, ROW_BLOCK_BYTES // row_size)
+    
+    while end > 0:
+        begin = max(0, end - rows_per_block)
+        f.seek(start + begin * row_size)
+        rows = parse_rows(f.read((end - begin) * row_size), width, bit_depth,
+                          color_table, row_size, packed)
+        rows.reverse()
+        yield from rows
+        end = begin
+
+
 class BMPRowReader:
     """Helper class to read and manage BMP rows with proper orientation."""
     
-    def __init__(self, f, width, height, bit_depth, color_table, row_size, top_down):
+    def __init__(self, f, width, height, bit_depth, color_table, row_size, top_down,
+                 packed=False):
         """
         Initialize row reader.
         
@@ -216,6 +381,7 @@ class BMPRowReader:
             color_table: Color palette for indexed formats (or None)
             row_size: Row size in bytes (including padding)
             top_down: Whether image is stored top-down
+            packed: Yield compact PackedRows instead of lists of RGB tuples
         """
         self.f = f
         self.width = width
@@ -224,19 +390,244 @@ class BMPRowReader:
         self.color_table = color_table
         self.row_size = row_size
         self.top_down = top_down
+        self.packed = packed
     
     def read_rows(self):
         """
         Generator that yields rows one at a time from file.
         
         Yields:
-            List of (R, G, B) tuples for each row
+            List of (R, G, B) tuples for each row (PackedRow if packed)
             Rows are yielded in the order they appear in the file
             (bottom-to-top for standard BMPs, top-to-bottom for top-down BMPs)
         """
-        # Yield rows one at a time (streaming)
-        for _ in range(self.height):
-            row = get_next_row(self.f, self.width, self.bit_depth, 
-                             self.color_table, self.row_size)
-            if row is not None:
-                yield row
+        # Read and decode a block of rows at a time, yield rows one at a time
+        rows_per_block = max(1, ROW_BLOCK_BYTES // self.row_size)
+        remaining = self.height
+        while remaining > 0:
+            count = min(rows_per_block, remaining)
+            block_data = self.f.read(count * self.row_size)
+            if not block_data:
+                break
+            rows = parse_rows(block_data, self.width, self.bit_depth,
+                              self.color_table, self.row_size, self.packed)
+            if not rows:
+                break
+            remaining -= len(rows)
+            yield from rows
+    
+    def read_rows_reversed(self):
+        """
+        Generator that yields rows in reverse file order using bounded memory.
+        
+        Seekable files are read backwards in blocks. Other files (pipes,
+        sockets) have their raw pixel data spilled to a temporary file first,
+        which is then read backwards instead of buffering rows in RAM.
+        Must be called before read_rows() has consumed any rows.
+        
+        Yields:
+            List of (R, G, B) tuples for each row, last row in the file first
+        """
+        if self.f.seekable():
+            yield from read_rows_backwards(self.f, self.f.tell(), self.height, self.width,
+                                           self.bit_depth, self.color_table, self.row_size,
+                                           self.packed)
+            return
+        
+        with tempfile.TemporaryFile() as spill:
+            remaining = self.height * self.row_size
+            while remaining > 0:
+                chunk = self.f.read(min(remaining, ROW_BLOCK_BYTES))
+                if not chunk:
+                    break
+                spill.write(chunk)
+                remaining -= len(chunk)
+            yield from read_rows_backwards(spill, 0, self.height, self.width,
+                                           self.bit_depth, self.color_table, self.row_size,
+                                           self.packed)
+
+
+class MappedBMPReader:
+    """
+    Random-access BMP reader backed by a read-only memory map of the file.
+    
+    Rows and windows are returned as zero-copy memoryviews into the map, so
+    only the pages that are actually touched get read from disk. Row indices
+    follow file order, the same order BMPRowReader.read_rows yields
+    (bottom-to-top for standard BMPs, top-to-bottom for top-down BMPs).
+    
+    Memoryviews handed out by the reader must be released (or dropped)
+    before close() is called.
+    
+    Usage:
+        with MappedBMPReader('huge.bmp') as bmp:
+            last = bmp.row(-1)
+            tile = bmp.window(100, 200, 64, 64)
+            pixels = bmp.parse(tile[0], 64)
+    """
+    
+    def __init__(self, filename):
+        """
+        Open and map a BMP file.
+        
+        Args:
+            filename: Path to BMP file
+            
+        Raises:
+            ValueError: If file is not a valid BMP or its pixel data is truncated
+        """
+        self.f = open(filename, 'rb')
+        try:
+            (self.pixel_offset, dib_header_size, self.width, self.height,
+             self.bit_depth, self.top_down) = read_bmp_headers(self.f)
+            self.color_table = read_color_table(self.f, dib_header_size, self.bit_depth)
+            self.row_size = calculate_row_size(self.width, self.bit_depth)
+            self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.f.close()
+            raise
+        
+        if len(self.map) < self.pixel_offset + self.row_size * self.height:
+            self.map.close()
+            self.f.close()
+            raise ValueError("BMP pixel data is truncated")
+        
+        self.view = memoryview(self.map)
+        # Bytes of real pixel data per row (excludes padding)
+        self.row_bytes = (self.width * self.bit_depth + 7) // 8
+    
+    def __len__(self):
+        return self.height
+    
+    def __iter__(self):
+        """Iterate raw rows in file order."""
+        for i in range(self.height):
+            yield self.row(i)
+    
+    def __reversed__(self):
+        """Iterate raw rows in reverse file order."""
+        for i in range(self.height - 1, -1, -1):
+            yield self.row(i)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def close(self):
+        """Release the memory map and close the file."""
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+            self.map.close()
+            self.f.close()
+    
+    def row_offset(self, i):
+        """
+        Get the file offset of a row.
+        
+        Args:
+            i: Row index in file order (negative indices count from the end)
+            
+        Returns:
+            Byte offset of the start of the row in the file
+            
+        Raises:
+            IndexError: If the row index is out of range
+        """
+        if i < 0:
+            i += self.height
+        if not 0 <= i < self.height:
+            raise IndexError("row index out of range")
+        return self.pixel_offset + i * self.row_size
+    
+    def row(self, i):
+        """
+        Get the raw pixel bytes of a row in O(1) without copying.
+        
+        Args:
+            i: Row index in file order (negative indices count from the end)
+            
+        Returns:
+            memoryview of the row's pixel bytes (padding excluded)
+        """
+        start = self.row_offset(i)
+        return self.view[start:start + self.row_bytes]
+    
+    def window(self, x, y, w, h):
+        """
+        Get a rectangular region as zero-copy row slices.
+        
+        Args:
+            x: Left pixel column
+            y: First row index in file order
+            w: Window width in pixels
+            h: Number of rows
+            
+        Returns:
+            List of h memoryviews, each holding w pixels of raw row data
+            
+        Raises:
+            ValueError: If the window is out of bounds, or the bit depth
+                packs several pixels per byte (1 and 4-bit)
+        """
+        if self.bit_depth < 8:
+            raise ValueError("Windows need whole-byte pixels, got %d-bit" % self.bit_depth)
+        if x < 0 or y < 0 or w < 0 or h < 0 or x + w > self.width or y + h > self.height:
+            raise ValueError("Window (%d, %d, %d, %d) is outside the %dx%d image"
+                             % (x, y, w, h, self.width, self.height))
+        
+        bytes_per_pixel = self.bit_depth // 8
+        left = x * bytes_per_pixel
+        right = left + w * bytes_per_pixel
+        return [self.row(i)[left:right] for i in range(y, y + h)]
+    
+    def parse(self, row_data, width=None):
+        """
+        Decode raw row bytes (from row() or window()) into RGB tuples.
+        
+        Args:
+            row_data: Raw pixel bytes
+            width: Number of pixels in row_data (defaults to image width)
+            
+        Returns:
+            List of (R, G, B) tuples
+        """
+        if width is None:
+            width = self.width
+        return parse_row(row_data, width, self.bit_depth, self.color_table)
+    
+    def read_rows(self, reverse=False):
+        """
+        Generator that yields decoded rows, like BMPRowReader.read_rows.
+        
+        Args:
+            reverse: Yield rows in reverse file order
+            
+        Yields:
+            List of (R, G, B) tuples for each row
+        """
+        rows = reversed(self) if reverse else iter(self)
+        for row_data in rows:
+            pixels = self.parse(row_data)
+            row_data.release()
+            yield pixels
+    
+    def read_window(self, x, y, w, h):
+        """
+        Generator that yields the decoded rows of a window.
+        
+        Args:
+            x: Left pixel column
+            y: First row index in file order
+            w: Window width in pixels
+            h: Number of rows
+            
+        Yields:
+            List of w (R, G, B) tuples for each row of the window
+        """
+        for row_data in self.window(x, y, w, h):
+            pixels = self.parse(row_data, w)
+            row_data.release()
+            yield pixels
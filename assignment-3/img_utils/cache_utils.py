@@ -0,0 +1,650 @@
+"""
+Cache Utility Functions
+Caches that let repeated pipeline runs skip work.
+
+ResultCache is an on-disk, content-addressed cache of pipeline outputs. A
+run is identified by its input file (mtime and size, or a hash of its
+contents), a fingerprint of its transformations and the writer's settings;
+when the same combination runs again, the stored output is copied to the
+requested filename instead of decoding, transforming and encoding.
+
+StageCache keeps intermediate row streams, so runs whose transformation
+lists share a prefix resume from the longest recorded stage.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import types
+from collections import OrderedDict
+
+from img_utils.bmp_reader_utils import BMPRowReader
+from img_utils.pipeline_utils import execute_planned, get_writer_config
+from img_utils.row_utils import PackedRow, as_packed, as_pixels
+from img_utils.stream_utils import RowStream, read_bmp_stream
+
+# Bump to invalidate every existing cache entry when the key format changes
+_KEY_VERSION = 2
+
+# Bytes read at a time when hashing input files
+_HASH_BLOCK_BYTES = 1 << 20
+
+# Default object repr, which only identifies an object within one process
+_ADDRESS_REPR = re.compile(r' at 0x[0-9a-fA-F]+>')
+
+
+class ResultCache:
+    """
+    Directory of cached pipeline outputs with size-bounded LRU eviction.
+
+    Each entry is one file named by its key. A hit refreshes the entry's
+    modification time, and eviction removes the entries used longest ago
+    until the cache fits in max_bytes. Entries are written to a temporary
+    file and renamed into place, so concurrent processes sharing a cache
+    directory never see partial outputs.
+    """
+
+    def __init__(self, directory=None, max_bytes=1 << 30):
+        """
+        Initialize result cache.
+
+        Args:
+            directory: Cache directory (created if missing; defaults to
+                img_utils_cache in the system temp directory)
+            max_bytes: Total size the cache is trimmed to after each store
+        """
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'img_utils_cache')
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def fetch(self, key, output_filename):
+        """
+        Copy a cached output to output_filename.
+
+        Args:
+            key: Cache key (see pipeline_key)
+            output_filename: Where the output should be written
+
+        Returns:
+            True on a hit, False on a miss
+        """
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, output_filename)
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, output_filename):
+        """
+        Add a freshly written output to the cache, then evict if over size.
+
+        Args:
+            key: Cache key (see pipeline_key)
+            output_filename: Output file to copy into the cache
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as dst, open(output_filename, 'rb') as src:
+                shutil.copyfileobj(src, dst)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        with self._lock:
+            self.stores += 1
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_bytes."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def clear(self):
+        """Remove every entry."""
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                os.unlink(entry.path)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """Counters as a dictionary."""
+        return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores,
+                'evictions': self.evictions, 'hit_rate': self.hit_rate}
+
+    def summary(self):
+        """One-line report of cache activity."""
+        return ('%d hits, %d misses (%.0f%% hit rate), %d stored, %d evicted'
+                % (self.hits, self.misses, self.hit_rate * 100, self.stores, self.evictions))
+
+    def __str__(self):
+        return self.summary()
+
+
+def pipeline_key(input_filename, transformations, writer_config, hash_input=False):
+    """
+    Compute the cache key of a pipeline run.
+
+    Args:
+        input_filename: Path to the input file
+        transformations: List of transformation functions
+        writer_config: Writer description (see describe_writer); the output
+            filename is left out, so the same result is shared by any path
+        hash_input: Identify the input by a SHA-256 of its contents instead
+            of its path, modification time and size (slower, but survives
+            copies and touch)
+
+    Returns:
+        Hex string key
+    """
+    if hash_input:
+        digest = hashlib.sha256()
+        with open(input_filename, 'rb') as f:
+            for block in iter(lambda: f.read(_HASH_BLOCK_BYTES), b''):
+                digest.update(block)
+        source = ('sha256', digest.hexdigest())
+    else:
+        stat = os.stat(input_filename)
+        source = ('stat', os.path.abspath(input_filename), stat.st_mtime_ns, stat.st_size)
+
+    writer = sorted((name, _fingerprint(value, set()))
+                    for name, value in writer_config.items() if name != 'filename')
+    parts = (_KEY_VERSION, source, [transform_fingerprint(t) for t in transformations], writer)
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def transform_fingerprint(transform):
+    """
+    Get a canonical, process-independent description of a transformation.
+
+    Functions are described by their module, qualified name, bytecode and
+    the names they look up, plus the values captured in their closure and
+    defaults, so brightness(1.2) and brightness(1.5) differ while two
+    separately built brightness(1.2) match. Every module global a function
+    looks up (helpers such as luminance, constants, lookup tables) is
+    fingerprinted too, and classes are described by their methods' code, so
+    editing a helper or changing a module constant changes the key. Objects
+    contribute their class and public attributes, arrays their contents.
+
+    Note: State read indirectly (attributes of imported modules, files) is
+    not covered, so changing that requires clearing the cache.
+
+    Args:
+        transform: Transformation function (or any value)
+
+    Returns:
+        Hex string fingerprint
+
+    Raises:
+        TypeError: If some value can only be described by its address (its
+            repr() is the default '<... at 0x...>'), so no stable key exists
+    """
+    return hashlib.sha256(repr(_fingerprint(transform, set())).encode()).hexdigest()
+
+
+def _fingerprint(value, seen):
+    """Build a nested tuple of plain values describing value."""
+    if value is None or isinstance(value, (bool, int, float, complex, str)):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return ('bytes', hashlib.sha256(value).hexdigest())
+    if isinstance(value, (tuple, list, frozenset, set)):
+        items = [_fingerprint(item, seen) for item in value]
+        if isinstance(value, (set, frozenset)):
+            items.sort(key=repr)
+        return (type(value).__name__, tuple(items))
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted((repr(k), _fingerprint(v, seen)) for k, v in value.items())))
+
+    if id(value) in seen:
+        return ('cycle',)
+    seen = seen | {id(value)}
+
+    if isinstance(value, types.FunctionType):
+        code = value.__code__
+        closure = tuple(_fingerprint(cell.cell_contents, seen) if _cell_filled(cell) else ('empty',)
+                        for cell in (value.__closure__ or ()))
+        return ('function', value.__module__, value.__qualname__,
+                hashlib.sha256(code.co_code).hexdigest(),
+                code.co_names,
+                _fingerprint(code.co_consts, seen),
+                _fingerprint(value.__defaults__, seen),
+                closure,
+                _global_values(value, seen))
+    if isinstance(value, types.CodeType):
+        return ('code', value.co_name, hashlib.sha256(value.co_code).hexdigest(),
+                value.co_names,
+                _fingerprint(value.co_consts, seen))
+    if isinstance(value, type) and value.__module__ != 'builtins':
+        return ('class', value.__module__, value.__qualname__,
+                tuple(_fingerprint(base, seen) for base in value.__bases__),
+                _class_body(value, seen))
+    if isinstance(value, (types.BuiltinFunctionType, type)):
+        return ('named', getattr(value, '__module__', None), value.__qualname__)
+    if hasattr(value, 'dtype') and hasattr(value, 'tobytes'):
+        return ('array', str(value.dtype), getattr(value, 'shape', None),
+                hashlib.sha256(value.tobytes()).hexdigest())
+    if hasattr(value, '__dict__'):
+        public = {name: attr for name, attr in vars(value).items() if not name.startswith('_')}
+        return ('object', type(value).__module__, type(value).__qualname__,
+                _fingerprint(public, seen))
+    text = repr(value)
+    if _ADDRESS_REPR.search(text):
+        raise TypeError("Can't fingerprint %s: its repr() is only an address" % type(value).__name__)
+    return ('repr', text)
+
+
+def _class_body(cls, seen):
+    """Fingerprint the methods and plain class attributes a class defines."""
+    body = []
+    for name, attr in sorted(vars(cls).items()):
+        if isinstance(attr, (staticmethod, classmethod)):
+            attr = attr.__func__
+        if isinstance(attr, property):
+            attr = (attr.fget, attr.fset, attr.fdel)
+        elif not isinstance(attr, (types.FunctionType, bool, int, float, complex, str, bytes,
+                                   tuple, frozenset)):
+            continue  # Slots, C descriptors, __dict__ and the like
+        body.append((name, _fingerprint(attr, seen)))
+    return tuple(body)
+
+
+def _global_values(function, seen):
+    """Fingerprint the module globals a function (or its nested code) looks up by name."""
+    names = set()
+    codes = [function.__code__]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+
+    found = []
+    for name in sorted(names):
+        if name not in function.__globals__:
+            continue  # A builtin or an attribute name
+        value = function.__globals__[name]
+        if not isinstance(value, types.ModuleType):
+            found.append((name, _fingerprint(value, seen)))
+    return tuple(found)
+
+
+def _cell_filled(cell):
+    """Whether a closure cell has been assigned."""
+    try:
+        cell.cell_contents
+    except ValueError:
+        return False
+    return True
+
+
+def cached_run(cache, input_filename, transformations, image_writer, run, hash_input=False):
+    """
+    Run a pipeline through the cache.
+
+    The writer must be described with describe_writer and have a filename,
+    and the pipeline must have a stable key (see transform_fingerprint);
+    otherwise run() is simply called.
+
+    Args:
+        cache: ResultCache
+        input_filename: Path to the input file
+        transformations: List of transformation functions
+        image_writer: Writer function the pipeline writes with
+        run: Zero-argument function that executes the pipeline
+        hash_input: Key the input by content hash (see pipeline_key)
+
+    Returns:
+        True if the output came from the cache, False if run() produced it
+    """
+    config = get_writer_config(image_writer)
+    if config is None or not config.get('filename'):
+        run()
+        return False
+
+    try:
+        key = pipeline_key(input_filename, transformations, config, hash_input)
+    except TypeError:
+        run()  # No stable key, so never cache
+        return False
+    if cache.fetch(key, config['filename']):
+        return True
+    run()
+    cache.store(key, config['filename'])
+    return False
+
+
+def cached_with_transforms(transformations, cache, hash_input=False):
+    """
+    Cached counterpart of pipeline_helpers.with_transforms.
+
+    Args:
+        transformations: List of transformation functions
+        cache: ResultCache
+        hash_input: Key inputs by content hash (see pipeline_key)
+
+    Returns:
+        Function (input_filename, image_writer) that reuses cached outputs
+        and otherwise runs the planned pipeline (see execute_planned)
+
+    Usage:
+        cache = ResultCache('./.pipeline-cache')
+        enhance = cached_with_transforms([brightness(1.2), flip_vertical], cache)
+        enhance('photo.bmp', write_bmp(24, 'out.bmp'))
+        print(cache)
+    """
+    def process(input_filename, image_writer):
+        def run():
+            execute_planned(read_bmp_stream(input_filename), transformations, image_writer)
+        cached_run(cache, input_filename, transformations, image_writer, run, hash_input)
+
+    return process
+
+
+class _Stage:
+    """One cached row stream: metadata plus packed BGR rows in memory or on disk."""
+
+    def __init__(self, metadata, width, height, data=None, path=None, packed=True):
+        self.metadata = metadata
+        self.width = width
+        self.height = height
+        self.data = data
+        self.path = path
+        self.packed = packed
+        self.size = width * height * 3
+
+    def _read(self, reverse):
+        if self.path is None:
+            row_bytes = self.width * 3
+            starts = range(0, self.size, row_bytes)
+            for start in (reversed(starts) if reverse else starts):
+                yield PackedRow.from_bgr(self.data[start:start + row_bytes])
+            return
+        with open(self.path, 'rb') as f:
+            reader = BMPRowReader(f, self.width, self.height, 24, None, self.width * 3,
+                                  top_down=True, packed=True)
+            if reverse:
+                yield from reader.read_rows_reversed()
+            else:
+                yield from reader.read_rows()
+
+    def _replay(self, reverse):
+        rows = self._read(reverse)
+        return rows if self.packed else (as_pixels(row) for row in rows)
+
+    def stream(self):
+        """Replay the stage as a RowStream, in the row type it was recorded in."""
+        def rows():
+            return self._replay(reverse=False)
+
+        def reverse_rows():
+            return self._replay(reverse=True)
+
+        return RowStream(dict(self.metadata), rows, reverse_rows)
+
+    def spill(self, directory):
+        """Move the rows from memory to a file in directory."""
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix='.stage')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+        self.data = None
+
+    def discard(self):
+        """Delete the spill file, if any."""
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+class StageCache:
+    """
+    Bounded cache of decoded and intermediate row streams.
+
+    Running transformations [t1, t2, t3] on a file records the decoded rows
+    and the output of t1, t1+t2 and t1+t2+t3, keyed by the input file
+    (path, mtime, size) and the fingerprints of the prefix (see
+    transform_fingerprint). A later run whose list starts with a recorded
+    prefix replays that stage and only runs the remaining transformations.
+    Stages from the first transformation without a stable fingerprint on
+    are run but never recorded.
+
+    Stages are held as packed BGR bytes (3 bytes per pixel). When they pass
+    max_memory_bytes, the least recently used are spilled to temporary files;
+    past max_disk_bytes, the least recently used spilled stages are dropped.
+    While a run records, all of its stages together buffer at most
+    max_memory_bytes in memory and write the rest straight to spill files.
+    Replayed stages are RowStreams in the row type that was recorded
+    (PackedRows or tuple lists), so flip_vertical can read them backwards
+    without buffering.
+    """
+
+    def __init__(self, max_memory_bytes=256 << 20, max_disk_bytes=1 << 30,
+                 spill_directory=None):
+        """
+        Initialize stage cache.
+
+        Args:
+            max_memory_bytes: Total size of stages kept in memory
+            max_disk_bytes: Total size of stages spilled to disk
+            spill_directory: Directory for spill files (system temp by default)
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.spill_directory = spill_directory
+        self.hits = 0
+        self.misses = 0
+        self.stages_recorded = 0
+        self.stages_spilled = 0
+        self.stages_dropped = 0
+        self._stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def run(self, input_filename, transformations, image_writer):
+        """
+        Run a pipeline, resuming from the longest cached prefix.
+
+        Args:
+            input_filename: Path to BMP file
+            transformations: List of transformation functions
+            image_writer: Writer function
+
+        Returns:
+            Whatever image_writer returns
+        """
+        stat = os.stat(input_filename)
+        source = (os.path.abspath(input_filename), stat.st_mtime_ns, stat.st_size)
+        fingerprints = ()
+        for transform in transformations:
+            try:
+                fingerprints += (transform_fingerprint(transform),)
+            except TypeError:
+                break  # No stable key: stages from here on are not cached
+        cacheable = len(fingerprints)
+
+        start, stream = 0, None
+        with self._lock:
+            for length in range(cacheable, -1, -1):
+                stage = self._stages.get((source, fingerprints[:length]))
+                if stage is not None:
+                    self._stages.move_to_end((source, fingerprints[:length]))
+                    start, stream = length, stage.stream()
+                    self.hits += 1
+                    break
+            else:
+                self.misses += 1
+
+        budget = [self.max_memory_bytes]  # Shared by every stage this run records
+        if stream is None:
+            stream = self._record((source, ()), read_bmp_stream(input_filename), budget)
+        for length in range(start + 1, len(transformations) + 1):
+            stream = transformations[length - 1](stream)
+            if length <= cacheable:
+                stream = self._record((source, fingerprints[:length]), stream, budget)
+        return image_writer(stream)
+
+    def _record(self, key, row_generator, budget):
+        """
+        Pass a stream through, keeping a packed copy.
+
+        Rows are buffered in memory while the run's shared budget (budget[0]
+        bytes, split among all stages recorded by one run) lasts; past it,
+        the stage is moved to a spill file and recorded there.
+        """
+        metadata = next(row_generator)
+        yield metadata
+
+        width = metadata['width']
+        data = bytearray()
+        spill = None
+        packed_rows = None
+        recording = width > 0
+        try:
+            for row in row_generator:
+                if recording:
+                    if packed_rows is None:
+                        packed_rows = isinstance(row, PackedRow)
+                    packed = as_packed(row)
+                    size = len(data) if spill is None else spill.tell()
+                    if len(packed) != width or size > self.max_disk_bytes:
+                        recording = False  # Irregular rows or too large to keep
+                    else:
+                        chunk = packed.to_bgr()
+                        if spill is None and len(chunk) <= budget[0]:
+                            data += chunk
+                            budget[0] -= len(chunk)
+                        else:
+                            if spill is None:
+                                spill = tempfile.NamedTemporaryFile(
+                                    dir=self.spill_directory, suffix='.stage', delete=False)
+                                spill.write(data)
+                                budget[0] += len(data)
+                                data = bytearray()
+                            spill.write(chunk)
+                yield row
+
+            if recording:
+                if spill is None:
+                    height = len(data) // (width * 3)
+                    stage = _Stage(dict(metadata), width, height, data=data,
+                                   packed=packed_rows is not False)
+                else:
+                    height = spill.tell() // (width * 3)
+                    spill.close()
+                    stage = _Stage(dict(metadata), width, height, path=spill.name,
+                                   packed=packed_rows is not False)
+                    spill = None
+                    self.stages_spilled += 1
+                self._add(key, stage)
+        finally:
+            budget[0] += len(data)
+            if spill is not None:
+                spill.close()
+                os.unlink(spill.name)
+
+    def _add(self, key, stage):
+        with self._lock:
+            old = self._stages.pop(key, None)
+            if old is not None:
+                old.discard()
+            self._stages[key] = stage
+            self.stages_recorded += 1
+            self._enforce_limits()
+
+    def _enforce_limits(self):
+        """Spill, then drop, least recently used stages until both budgets hold."""
+        in_memory = [s for s in self._stages.values() if s.path is None]
+        memory = sum(s.size for s in in_memory)
+        for stage in in_memory:
+            if memory <= self.max_memory_bytes:
+                break
+            stage.spill(self.spill_directory)
+            memory -= stage.size
+            self.stages_spilled += 1
+
+        disk = sum(s.size for s in self._stages.values() if s.path is not None)
+        for key, stage in list(self._stages.items()):
+            if disk <= self.max_disk_bytes:
+                break
+            if stage.path is not None:
+                stage.discard()
+                del self._stages[key]
+                disk -= stage.size
+                self.stages_dropped += 1
+
+    def clear(self):
+        """Drop every stage and delete spill files."""
+        with self._lock:
+            for stage in self._stages.values():
+                stage.discard()
+            self._stages.clear()
+
+    def stats(self):
+        """Counters as a dictionary."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'stages_recorded': self.stages_recorded,
+                'stages_spilled': self.stages_spilled,
+                'stages_dropped': self.stages_dropped,
+                'stages': len(self._stages)}
+
+
+def cached_from_file(input_filename, stage_cache):
+    """
+    Counterpart of pipeline_helpers.from_file that shares work between runs.
+
+    Args:
+        input_filename: Source image file path
+        stage_cache: StageCache shared by the runs
+
+    Returns:
+        Function (transformations, image_writer)
+
+    Usage:
+        stages = StageCache()
+        process_photo = cached_from_file('photo.bmp', stages)
+        process_photo([flip_horizontal, grayscale], write_bmp(24, 'a.bmp'))
+        process_photo([flip_horizontal, grayscale, brightness(0.8)], write_bmp(24, 'b.bmp'))
+        # The second run resumes from the recorded flip_horizontal + grayscale stage
+    """
+    def process(transformations, image_writer):
+        return stage_cache.run(input_filename, transformations, image_writer)
+
+    return process
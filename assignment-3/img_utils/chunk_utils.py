@@ -0,0 +1,166 @@
+"""
+Chunk Utility Functions
+A chunked variant of the row generator protocol.
+
+A chunked generator yields the same metadata dictionary first, then lists
+of up to chunk_size rows (the last chunk may be shorter) instead of single
+rows. A chunked stage is resumed once per chunk rather than once per row,
+which is what dominates for small or short images run through long
+pipelines. Chunked stages are still functions from generator to generator,
+so compose and pipe work on them unchanged.
+
+Row transformations are lifted with chunked(). Point ops (brightness,
+grayscale, fused runs) and horizontal flips run directly on each chunk.
+Other transformations are wrapped with unchunk_rows and chunk_rows, which
+is correct for any transformation but saves nothing.
+"""
+
+from img_utils.pipeline_utils import (
+    FLIP_HORIZONTAL, ROW_LOCAL, fuse_point_ops, get_geometry, get_point_op, get_row_behavior,
+    set_row_behavior
+)
+from img_utils.row_utils import PackedRow
+
+# Rows per chunk used when none is given
+DEFAULT_CHUNK_ROWS = 64
+
+
+def chunk_rows(row_generator, chunk_size=DEFAULT_CHUNK_ROWS):
+    """
+    Convert a row generator to the chunked protocol.
+
+    Args:
+        row_generator: Generator yielding metadata, then rows
+        chunk_size: Maximum number of rows per chunk
+
+    Yields:
+        The metadata dictionary, then lists of rows
+    """
+    yield next(row_generator)
+    chunk = []
+    for row in row_generator:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def unchunk_rows(chunk_generator):
+    """
+    Convert a chunked generator back to the row protocol.
+
+    Args:
+        chunk_generator: Generator yielding metadata, then lists of rows
+
+    Yields:
+        The metadata dictionary, then rows
+    """
+    yield next(chunk_generator)
+    for chunk in chunk_generator:
+        yield from chunk
+
+
+def chunked(transform, chunk_size=DEFAULT_CHUNK_ROWS):
+    """
+    Lift a row transformation to the chunked protocol.
+
+    Args:
+        transform: Transformation function (row generator -> row generator)
+        chunk_size: Chunk size used when transform has to be run on rows
+
+    Returns:
+        Transformation function (chunked generator -> chunked generator)
+
+    Usage:
+        pipeline = compose(chunked(grayscale), chunked(flip_horizontal))
+        write_bmp(24, 'out.bmp')(unchunk_rows(pipeline(chunk_rows(read_bmp('in.bmp')))))
+    """
+    op = get_point_op(transform)
+    if op is not None:
+        apply_row = op.apply_row
+
+        def map_row(row):
+            out = apply_row(row)
+            return out if isinstance(row, PackedRow) else out.to_pixels()
+
+        return _chunk_map(transform, map_row)
+
+    if get_geometry(transform) == FLIP_HORIZONTAL:
+        return _chunk_map(transform, _flip_row)
+
+    def lifted(chunk_generator):
+        return chunk_rows(transform(unchunk_rows(chunk_generator)), chunk_size)
+
+    return lifted
+
+
+def _flip_row(row):
+    """Mirror one row (PackedRow or list of tuples) left-right."""
+    return row.flipped() if isinstance(row, PackedRow) else row[::-1]
+
+
+def _chunk_map(transform, map_row):
+    """Build a chunked stage applying map_row to every row."""
+    def mapped(chunk_generator):
+        # Run the original stage on the metadata alone so hints survive
+        metadata = next(chunk_generator)
+        yield next(transform(iter([metadata])))
+        for chunk in chunk_generator:
+            yield [map_row(row) for row in chunk]
+
+    if get_row_behavior(transform) == ROW_LOCAL:
+        set_row_behavior(mapped, ROW_LOCAL)
+    return mapped
+
+
+def unchunked(chunk_transform, chunk_size=DEFAULT_CHUNK_ROWS):
+    """
+    Run a chunked stage as a row transformation.
+
+    Args:
+        chunk_transform: Chunked stage (chunked generator -> chunked generator)
+        chunk_size: Maximum number of rows per chunk fed to the stage
+
+    Returns:
+        Transformation function (row generator -> row generator)
+    """
+    def transform(row_generator):
+        return unchunk_rows(chunk_transform(chunk_rows(row_generator, chunk_size)))
+
+    return transform
+
+
+def chunked_pipeline(transformations, chunk_size=DEFAULT_CHUNK_ROWS):
+    """
+    Combine row transformations into one row transformation run on chunks.
+
+    Runs of point ops are fused first (see fuse_point_ops), then every
+    stage is lifted with chunked(). Rows are chunked once on the way in and
+    unchunked once on the way out, so the result drops in wherever a row
+    transformation is expected and yields the same metadata and rows.
+
+    Args:
+        transformations: List of transformation functions, applied in order
+        chunk_size: Maximum number of rows per chunk
+
+    Returns:
+        Transformation function (row generator -> row generator)
+
+    Usage:
+        execute_transformation_pipeline(read_bmp('in.bmp'),
+                                        [chunked_pipeline([flip_horizontal, grayscale, brightness(1.2)])],
+                                        write_bmp(24, 'out.bmp'))
+    """
+    stages = [chunked(transform, chunk_size) for transform in fuse_point_ops(transformations)]
+
+    def run(chunk_generator):
+        for stage in stages:
+            chunk_generator = stage(chunk_generator)
+        return chunk_generator
+
+    transform = unchunked(run, chunk_size)
+    if all(get_row_behavior(stage) == ROW_LOCAL for stage in stages):
+        set_row_behavior(transform, ROW_LOCAL)
+    return transform
@@ -1,27 +1,67 @@
 """
 GIF Writer Utility Functions
-Helper functions for writing GIF files using PIL/Pillow.
+Helper functions for writing GIF files.
+
+convert_to_gif builds a PIL/Pillow image from the whole buffered image.
+write_gif_streaming is a native encoder that needs no third-party library:
+given a palette (fixed, or estimated from a sample) it maps and LZW-encodes
+rows one at a time, so memory use doesn't grow with the image.
 """
 
-try:
-    from PIL import Image
-except ImportError:
-    raise ImportError("PIL/Pillow is required for GIF writing. Install with: pip install Pillow")
+import queue
+import struct
+import tempfile
+import threading
+
+from img_utils.bmp_reader_utils import BMPRowReader
+from img_utils.bmp_writer_utils import (
+    estimate_palette, get_palette_index, get_quantizer, gray_palette
+)
+from img_utils.row_utils import as_packed, collect_gray, gray_channel, gray_hint, is_gray_row
+from img_utils.stream_utils import spill_reversed
+
+# Precompiled GIF block layouts: logical screen descriptor and image descriptor
+_SCREEN_DESCRIPTOR = struct.Struct('<6sHHBBB')
+_IMAGE_DESCRIPTOR = struct.Struct('<BHHHHB')
+
+# Largest LZW code table allowed by GIF (12-bit codes)
+_LZW_MAX_CODES = 1 << 12
+
+# Encoded bytes gathered before the LZW encoder writes its data sub-blocks
+_LZW_FLUSH_BYTES = 1 << 16
+
 
+def _pil_image():
+    """Import PIL.Image on first use, so the native encoder works without Pillow."""
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError("PIL/Pillow is required for convert_to_gif. Install with: pip install Pillow")
+    return Image
 
-def convert_to_gif(row_generator, width, height, top_down=False):
+
+def convert_to_gif(row_generator, width, height, top_down=False, quantizer=None,
+                   palette=None, grayscale=None):
     """
     Convert rows from a generator to a GIF image.
     
-    Note: GIF format requires buffering the entire image before writing due to
-    LZW compression requirements. Unlike BMP, we cannot stream rows directly.
+    Note: This buffers the entire image so PIL can choose a palette from all
+    pixels. To stream rows in constant memory, use write_gif_streaming.
     
     Args:
         row_generator: Generator yielding rows of RGB tuples
         width: Image width
         height: Image height
         top_down: Whether image rows are in top-down order (True) or bottom-up (False)
+        quantizer: Quantizer backend name or function from bmp_writer_utils
+            (see QUANTIZERS); PIL's adaptive palette is used when omitted
+        palette: Fixed palette of up to 256 (R, G, B) tuples shared across
+            images (see palette_utils); skips quantization entirely
+        grayscale: False if the rows are known not to be gray; otherwise
+            (None, or True from row_utils.gray_hint) every row is checked
     """
+    Image = _pil_image()
+    
     # Buffer all rows (required for GIF)
     rows = list(row_generator)
     
@@ -30,20 +70,32 @@ def convert_to_gif(row_generator, width, height, top_down=False):
     if not top_down:
         rows.reverse()
     
-    # Flatten rows into a single list of pixels
-    pixels = []
-    for row in rows:
-        pixels.extend(row)
+    if palette is not None:
+        # Fixed palette: map pixels with the cached nearest-color index
+        palette_index = get_palette_index(palette)
+        return _indexed_image(palette, [palette_index.map_row(row) for row in rows],
+                              width, height)
     
-    # Check if image is grayscale
-    is_grayscale = all(r == g == b for r, g, b in pixels)
+    # Check if image is grayscale; stops at the first row with color. A gray
+    # hint is checked too, since an untagged stage may have added color.
+    if grayscale is not False:
+        grayscale = all(is_gray_row(row) for row in rows)
     
-    if is_grayscale:
+    if grayscale:
         # Grayscale mode - convert to single channel
-        gray_pixels = [r for r, g, b in pixels]  # R == G == B
+        gray_pixels = b''.join(gray_channel(row) for row in rows)  # R == G == B
         img = Image.new('L', (width, height))
         img.putdata(gray_pixels)
+    elif quantizer is not None:
+        # Palette mode with our own quantizer backend
+        palette, pixel_indices = get_quantizer(quantizer)(rows, 256)
+        img = _indexed_image(palette, pixel_indices, width, height)
     else:
+        # Flatten rows into a single list of pixels
+        pixels = []
+        for row in rows:
+            pixels.extend(row)
+        
         # RGB mode - convert to palette with 256 colors
         img = Image.new('RGB', (width, height))
         img.putdata(pixels)
@@ -52,3 +104,468 @@ def convert_to_gif(row_generator, width, height, top_down=False):
         img = img.convert('P', palette=Image.ADAPTIVE, colors=256)
     
     return img
+
+
+def _indexed_image(palette, pixel_indices, width, height):
+    """Build a palette-mode image from a palette and rows of palette indices."""
+    Image = _pil_image()
+    img = Image.new('P', (width, height))
+    img.putpalette([channel for color in palette for channel in color])
+    img.putdata([index for index_row in pixel_indices for index in index_row])
+    return img
+
+
+def write_gif_streaming(f, row_generator, width, height, top_down=False, palette=None,
+                        max_samples=200000, grayscale=None):
+    """
+    Write a GIF file with the native LZW encoder, one row at a time.
+    
+    With a palette, rows are mapped through the cached nearest-color index
+    and encoded as they arrive. Without one, the rows are spilled to a
+    temporary file while a random sample of max_samples pixels is drawn,
+    the palette is estimated from that sample (see estimate_palette) and
+    the spilled rows are then encoded; if every row turned out gray while
+    spilling, the identity gray palette is used instead. Bottom-up input is
+    reversed through a temporary file as well, since GIF stores rows top to
+    bottom. Memory use is bounded either way.
+    
+    Args:
+        f: File object opened in binary write mode
+        row_generator: Generator yielding rows of RGB tuples (or PackedRows)
+        width: Image width (1-65535)
+        height: Image height (1-65535)
+        top_down: Whether image rows are in top-down order (True) or bottom-up (False)
+        palette: Fixed palette of up to 256 (R, G, B) tuples (see palette_utils)
+        max_samples: Pixels sampled to estimate a palette when none is given
+        grayscale: True if the rows are marked gray (see row_utils.gray_hint):
+            no palette sample is drawn while spilling, and one is only
+            estimated from the spilled rows if some row has color after all
+        
+    Raises:
+        ValueError: If the image size doesn't fit in a GIF
+        
+    Usage:
+        with open('out.gif', 'wb') as f:
+            write_gif_streaming(f, rows, width, height, palette=load_palette('scan.pal'))
+    """
+    if not (0 < width <= 0xFFFF and 0 < height <= 0xFFFF):
+        raise ValueError("GIF images must be 1 to 65535 pixels wide and high, got %dx%d"
+                         % (width, height))
+    
+    if palette is not None:
+        rows = row_generator if top_down else spill_reversed(row_generator, width)
+        _write_gif_file(f, rows, width, height, palette)
+        return
+    
+    with tempfile.TemporaryFile() as spill:
+        spilled = []
+        all_gray = [True]
+        
+        def spill_rows():
+            for row in row_generator:
+                spill.write(as_packed(row).to_bgr())
+                spilled.append(None)
+                if all_gray[0]:
+                    all_gray[0] = is_gray_row(row)
+                yield row
+        
+        if grayscale:
+            for row in spill_rows():
+                pass
+        else:
+            palette, error = estimate_palette(spill_rows(), max_samples=max_samples)
+        reader = BMPRowReader(spill, width, len(spilled), 24, None, width * 3,
+                              top_down=True, packed=True)
+        if all_gray[0] and spilled:
+            palette = gray_palette()
+        elif grayscale:
+            spill.seek(0)  # The hint was wrong: sample the spilled rows
+            palette, error = estimate_palette(reader.read_rows(), max_samples=max_samples)
+        if not palette:
+            palette = [(0, 0, 0)]
+        
+        spill.seek(0)
+        rows = reader.read_rows() if top_down else reader.read_rows_reversed()
+        _write_gif_file(f, rows, width, height, palette)
+
+
+def _write_gif_file(f, rows, width, height, palette):
+    """Write a single-image GIF: header, global palette, encoded rows, trailer."""
+    palette, min_code_size = _gif_palette(palette)
+    _write_gif_header(f, width, height, palette)
+    palette_index = get_palette_index(palette)
+    _write_gif_image(f, (palette_index.map_row(row) for row in rows),
+                     0, 0, width, height, min_code_size)
+    f.write(b'\x3b')  # Trailer
+
+
+def _gif_palette(palette):
+    """
+    Pad a palette to the power-of-two size GIF color tables need.
+    
+    Returns:
+        Tuple of (padded palette, LZW minimum code size)
+    """
+    palette = [tuple(color) for color in palette]
+    if not 0 < len(palette) <= 256:
+        raise ValueError("Palette must have 1 to 256 colors, got %d" % len(palette))
+    size_bits = max(1, (len(palette) - 1).bit_length())
+    palette.extend([(0, 0, 0)] * ((1 << size_bits) - len(palette)))
+    return palette, max(2, size_bits)
+
+
+def _write_gif_header(f, width, height, palette):
+    """
+    Write the GIF89a header, logical screen descriptor and global color table.
+    
+    Args:
+        f: File object opened in binary write mode
+        width: Logical screen width
+        height: Logical screen height
+        palette: Global palette, already padded to a power of two (2-256)
+    """
+    size_bits = (len(palette) - 1).bit_length()
+    # Global color table present, 8 bits of color resolution, table size
+    flags = 0x80 | 0x70 | (size_bits - 1)
+    f.write(_SCREEN_DESCRIPTOR.pack(b'GIF89a', width, height, flags, 0, 0)
+            + bytes(channel for color in palette for channel in color))
+
+
+def _write_gif_image(f, index_rows, left, top, width, height, min_code_size,
+                     local_palette=None):
+    """
+    Write an image descriptor and its LZW-compressed pixel data.
+    
+    Args:
+        f: File object opened in binary write mode
+        index_rows: Iterable of rows of palette indices, top row first
+        left: Image position on the logical screen
+        top: Image position on the logical screen
+        width: Image width
+        height: Image height
+        min_code_size: LZW minimum code size (from _gif_palette)
+        local_palette: Palette for this image only, already padded to a
+            power of two (None to use the global color table)
+    """
+    if local_palette is None:
+        f.write(_IMAGE_DESCRIPTOR.pack(0x2C, left, top, width, height, 0))
+    else:
+        # Local color table present, and its size
+        flags = 0x80 | ((len(local_palette) - 1).bit_length() - 1)
+        f.write(_IMAGE_DESCRIPTOR.pack(0x2C, left, top, width, height, flags)
+                + bytes(channel for color in local_palette for channel in color))
+    f.write(bytes([min_code_size]))
+    encoder = _LZWEncoder(f, min_code_size)
+    for index_row in index_rows:
+        encoder.encode(index_row)
+    encoder.finish()
+
+
+class _LZWEncoder:
+    """
+    Incremental GIF LZW encoder.
+    
+    Indices are fed in with encode() as they become available and the
+    compressed codes are written to the file as 255-byte data sub-blocks.
+    The string table is a dict keyed by (prefix code << 8) | index; when it
+    reaches 4096 codes a clear code is sent and the table starts over.
+    """
+    
+    def __init__(self, f, min_code_size):
+        """
+        Initialize encoder and emit the initial clear code.
+        
+        Args:
+            f: File object opened in binary write mode
+            min_code_size: LZW minimum code size (2-8)
+        """
+        self.f = f
+        self.min_code_size = min_code_size
+        self.clear_code = 1 << min_code_size
+        self.end_code = self.clear_code + 1
+        self.out = bytearray()
+        self.bits = 0
+        self.bit_count = 0
+        self.prefix = None
+        self._reset_table()
+        self._emit(self.clear_code)
+    
+    def _reset_table(self):
+        self.table = {}
+        self.next_code = self.end_code + 1
+        self.code_size = self.min_code_size + 1
+    
+    def _emit(self, code):
+        """Append one code to the bit stream (least significant bit first)."""
+        self.bits |= code << self.bit_count
+        self.bit_count += self.code_size
+        while self.bit_count >= 8:
+            self.out.append(self.bits & 0xFF)
+            self.bits >>= 8
+            self.bit_count -= 8
+    
+    def encode(self, indices):
+        """
+        Encode a run of palette indices.
+        
+        Args:
+            indices: Iterable of palette indices
+        """
+        table = self.table
+        prefix = self.prefix
+        for index in indices:
+            if prefix is None:
+                prefix = index
+                continue
+            key = (prefix << 8) | index
+            code = table.get(key)
+            if code is not None:
+                prefix = code
+                continue
+            self._emit(prefix)
+            if self.next_code < _LZW_MAX_CODES:
+                table[key] = self.next_code
+                self.next_code += 1
+                # The decoder adds each entry one code later, so it widens
+                # codes once the table passes the current code size
+                if self.next_code > (1 << self.code_size) and self.code_size < 12:
+                    self.code_size += 1
+            else:
+                self._emit(self.clear_code)
+                self._reset_table()
+                table = self.table
+            prefix = index
+        self.prefix = prefix
+        if len(self.out) >= _LZW_FLUSH_BYTES:
+            self._flush()
+    
+    def finish(self):
+        """Emit the pending string and the end code, then terminate the data."""
+        if self.prefix is not None:
+            self._emit(self.prefix)
+        self._emit(self.end_code)
+        if self.bit_count:
+            self.out.append(self.bits & 0xFF)
+            self.bits = 0
+            self.bit_count = 0
+        self._flush(final=True)
+        self.f.write(b'\x00')  # Block terminator
+    
+    def _flush(self, final=False):
+        """Write complete 255-byte sub-blocks (all remaining bytes if final)."""
+        out = self.out
+        usable = len(out) if final else len(out) - len(out) % 255
+        blocks = bytearray()
+        for start in range(0, usable, 255):
+            chunk = out[start:start + 255]
+            blocks.append(len(chunk))
+            blocks += chunk
+        self.f.write(blocks)
+        del out[:usable]
+
+
+# Graphic control extension layout: introducer, label, block size, flags,
+# delay (centiseconds), transparent color index, block terminator
+_GRAPHIC_CONTROL = struct.Struct('<BBBBHBB')
+
+# Disposal method 1: leave the frame in place, so the next frame's changed
+# rectangle is drawn over it
+_DISPOSE_KEEP = 1 << 2
+
+# Marker put on the frame queue by the decoding thread
+_FRAMES_DONE = object()
+
+
+def write_animated_gif(f, frames, top_down=False, palette=None, delay=100, loop=0,
+                       delta=True, max_queued_frames=2, max_samples=200000):
+    """
+    Write an animated GIF with one frame per row stream.
+    
+    All frames share one global palette: the given one, the identity gray
+    palette if the first frame is marked gray and every row of it is, or
+    else one estimated from the first frame (for sweeps whose colors drift,
+    build it from several frames with palette_utils.build_shared_palette).
+    With the gray palette, a later frame that has color gets a palette of
+    its own (a local color table) and is stored whole. With delta encoding,
+    each other frame after the first only stores the rectangle of pixels
+    that changed since the previous frame.
+    
+    Frames are decoded and mapped to palette indices on a worker thread
+    while the main thread LZW-encodes and writes the previous frame; at most
+    max_queued_frames decoded frames wait in between. Pure-Python pipeline
+    stages still share the GIL, so the overlap mostly hides file reads.
+    
+    Args:
+        f: File object opened in binary write mode
+        frames: Iterable of row generators (metadata first, then rows), one
+            per frame; all frames must have the same size
+        top_down: Whether frame rows are in top-down order (True) or bottom-up (False)
+        palette: Global palette of up to 256 (R, G, B) tuples
+        delay: Milliseconds each frame is shown: one number for all frames,
+            or a sequence with one value per frame (GIF stores hundredths
+            of a second)
+        loop: Number of times to repeat (0 = forever, None = play once
+            without a NETSCAPE2.0 loop extension)
+        delta: Store only the changed rectangle of each frame after the first
+        max_queued_frames: Decoded frames allowed to wait for the encoder
+        max_samples: Pixels sampled from the first frame when estimating a palette
+        
+    Returns:
+        Number of frames written
+        
+    Raises:
+        ValueError: If there are no frames or their sizes differ
+        
+    Usage:
+        def brightness_sweep(filename, steps):
+            for i in range(steps):
+                yield brightness(0.5 + i / steps)(read_bmp(filename))
+        
+        with open('sweep.gif', 'wb') as f:
+            write_animated_gif(f, brightness_sweep('photo.bmp', 10), delay=80)
+    """
+    frame_queue = queue.Queue(maxsize=max_queued_frames)
+    stop = threading.Event()
+    decoder = threading.Thread(target=_decode_frames,
+                               args=(frames, top_down, palette, max_samples, frame_queue, stop),
+                               daemon=True)
+    decoder.start()
+    
+    try:
+        count = 0
+        previous = None
+        previous_local = False
+        while True:
+            item = frame_queue.get()
+            if item is _FRAMES_DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            width, height, index_rows, palette, min_code_size, local = item
+            
+            if previous is None:
+                screen_width, screen_height = width, height
+                _write_gif_header(f, width, height, palette)
+                if loop is not None:
+                    _write_loop_extension(f, loop)
+            elif (width, height) != (screen_width, screen_height):
+                raise ValueError("Frame %d is %dx%d, expected %dx%d"
+                                 % (count, width, height, screen_width, screen_height))
+            
+            left, top, right, bottom = 0, 0, width, height
+            if delta and previous is not None and not local and not previous_local:
+                left, top, right, bottom = _changed_rect(previous, index_rows, width)
+            frame_delay = delay if isinstance(delay, (int, float)) else delay[count]
+            f.write(_GRAPHIC_CONTROL.pack(0x21, 0xF9, 4, _DISPOSE_KEEP,
+                                          int(round(frame_delay / 10)), 0, 0))
+            _write_gif_image(f, (row[left:right] for row in index_rows[top:bottom]),
+                             left, top, right - left, bottom - top, min_code_size,
+                             palette if local else None)
+            previous, previous_local = index_rows, local
+            count += 1
+    finally:
+        stop.set()
+        decoder.join()
+    
+    if count == 0:
+        raise ValueError("An animated GIF needs at least one frame")
+    f.write(b'\x3b')  # Trailer
+    return count
+
+
+def _decode_frames(frames, top_down, palette, max_samples, frame_queue, stop):
+    """
+    Decoding thread: map each frame to rows of palette index bytes.
+    
+    Puts (width, height, index_rows, palette, min_code_size, local) tuples
+    on the queue (rows top first), then _FRAMES_DONE, or the exception that
+    stopped the decoding. local is True when palette is the frame's own
+    rather than the global one.
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    try:
+        palette_index = None
+        gray = False  # Global palette is the identity gray palette
+        for row_generator in frames:
+            metadata = next(row_generator)
+            width, height = metadata['width'], metadata['height']
+            if not (0 < width <= 0xFFFF and 0 < height <= 0xFFFF):
+                raise ValueError("GIF frames must be 1 to 65535 pixels wide and high, got %dx%d"
+                                 % (width, height))
+            
+            # Rows of a gray frame map straight to their gray values
+            gray_rows = None
+            if gray or (palette_index is None and palette is None and gray_hint(metadata)):
+                gray_rows, rows = collect_gray(row_generator)
+                if gray_rows is None:
+                    row_generator = iter(rows)
+            
+            local = False
+            if palette_index is None:
+                if gray_rows is not None:
+                    palette, gray = gray_palette(), True
+                if palette is None:
+                    rows = list(row_generator)
+                    palette, error = estimate_palette(rows, max_samples=max_samples)
+                    row_generator = iter(rows)
+                palette, min_code_size = _gif_palette(palette or [(0, 0, 0)])
+                palette_index = get_palette_index(palette)
+            frame_palette, frame_code_size, frame_index = palette, min_code_size, palette_index
+            if gray and gray_rows is None:
+                # Color in a gray animation: give this frame its own palette
+                frame_palette, error = estimate_palette(rows, max_samples=max_samples)
+                frame_palette, frame_code_size = _gif_palette(frame_palette or [(0, 0, 0)])
+                frame_index = get_palette_index(frame_palette)
+                local = True
+            
+            if gray_rows is not None:
+                index_rows = gray_rows
+            else:
+                index_rows = [bytes(frame_index.map_row(row)) for row in row_generator]
+            if not top_down:
+                index_rows.reverse()
+            if not put((width, height, index_rows, frame_palette, frame_code_size, local)):
+                return
+        put(_FRAMES_DONE)
+    except BaseException as exc:
+        put(exc)
+
+
+def _changed_rect(previous, index_rows, width):
+    """
+    Find the bounding rectangle of pixels that differ between two frames.
+    
+    Rows are compared as bytes; within a changed row the first and last
+    differing pixels come from the XOR of the two rows read as integers.
+    
+    Returns:
+        Tuple of (left, top, right, bottom), right and bottom exclusive. An
+        unchanged frame gives a 1x1 rectangle, since a GIF frame can't be empty.
+    """
+    left, right = width, 0
+    top = bottom = None
+    for y, (old, new) in enumerate(zip(previous, index_rows)):
+        if old == new:
+            continue
+        if top is None:
+            top = y
+        bottom = y + 1
+        diff = int.from_bytes(old, 'little') ^ int.from_bytes(new, 'little')
+        left = min(left, ((diff & -diff).bit_length() - 1) // 8)
+        right = max(right, (diff.bit_length() - 1) // 8 + 1)
+    if top is None:
+        return 0, 0, 1, 1
+    return left, top, right, bottom
+
+
+def _write_loop_extension(f, loop):
+    """Write the NETSCAPE2.0 application extension (loop count, 0 = forever)."""
+    f.write(b'\x21\xff\x0bNETSCAPE2.0' + struct.pack('<BBHB', 3, 1, loop, 0))
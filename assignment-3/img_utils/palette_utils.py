@@ -0,0 +1,102 @@
+"""
+Palette Utility Functions
+Compute a palette once and reuse it for many 8-bit BMP or GIF outputs.
+
+Images that share a look, such as the frames of one scan set, quantize to
+nearly the same palette. Building it once and passing it to write_8bit_bmp
+or convert_to_gif (palette=...) skips quantization for every image, reuses
+one cached nearest-color index, and keeps colors consistent across outputs.
+"""
+
+from itertools import chain
+
+from img_utils.bmp_writer_utils import estimate_palette
+from img_utils.stream_utils import read_bmp_stream
+
+# Header lines of the JASC-PAL text format used by save_palette
+_PALETTE_MAGIC = 'JASC-PAL'
+_PALETTE_VERSION = '0100'
+
+
+def build_shared_palette(sources, num_colors=256, max_samples=200000, seed=0):
+    """
+    Compute one palette representative of several images.
+
+    The images are streamed one after another and a uniform random sample
+    of max_samples pixels is kept across all of them (reservoir sampling),
+    so memory stays bounded however many images there are. The sample is
+    then quantized with median cut (see estimate_palette).
+
+    Args:
+        sources: Iterable of BMP file paths or row generators (metadata
+            first, then rows)
+        num_colors: Maximum number of palette colors
+        max_samples: Number of pixels sampled across all images
+        seed: Seed for the sampling
+
+    Returns:
+        List of at most num_colors (R, G, B) tuples
+
+    Usage:
+        palette = build_shared_palette(glob.glob('./scans/*.bmp'))
+        save_palette(palette, 'scans.pal')
+        ...
+        write_8bit_bmp(f, rows, width, height, palette=load_palette('scans.pal'))
+    """
+    rows = chain.from_iterable(_image_rows(source) for source in sources)
+    palette, error = estimate_palette(rows, num_colors, max_samples=max_samples, seed=seed)
+    return palette
+
+
+def _image_rows(source):
+    """Generator over the rows of a BMP file path or a row generator."""
+    row_generator = read_bmp_stream(source) if isinstance(source, str) else source
+    next(row_generator)  # Metadata
+    yield from row_generator
+
+
+def save_palette(palette, filename):
+    """
+    Save a palette as a JASC-PAL text file (one "R G B" line per color).
+
+    Args:
+        palette: List of (R, G, B) tuples
+        filename: Path to output palette file
+    """
+    with open(filename, 'w') as f:
+        f.write('%s\n%s\n%d\n' % (_PALETTE_MAGIC, _PALETTE_VERSION, len(palette)))
+        for r, g, b in palette:
+            f.write('%d %d %d\n' % (r, g, b))
+
+
+def load_palette(filename):
+    """
+    Load a palette saved by save_palette.
+
+    Args:
+        filename: Path to JASC-PAL palette file
+
+    Returns:
+        List of (R, G, B) tuples
+
+    Raises:
+        ValueError: If the file is not a valid JASC-PAL palette
+    """
+    with open(filename, 'r') as f:
+        lines = [line.strip() for line in f if line.strip()]
+
+    if len(lines) < 3 or lines[0] != _PALETTE_MAGIC:
+        raise ValueError("Not a JASC-PAL palette file: %s" % filename)
+    try:
+        count = int(lines[2])
+        palette = [tuple(int(value) for value in line.split()) for line in lines[3:3 + count]]
+    except ValueError:
+        raise ValueError("Malformed palette entry in %s" % filename)
+
+    if len(palette) != count or not 0 < count <= 256:
+        raise ValueError("Expected 1 to 256 colors in %s, declared %d, found %d"
+                         % (filename, count, len(palette)))
+    for color in palette:
+        if len(color) != 3 or not all(0 <= value <= 255 for value in color):
+            raise ValueError("Invalid color %r in %s" % (color, filename))
+    return palette
@@ -0,0 +1,132 @@
+"""
+Parallel Pipeline Utility Functions
+Runs a transformation pipeline over horizontal bands of a BMP file on a
+pool of worker processes.
+
+Each worker memory-maps the input file (MappedBMPReader), decodes its band,
+runs the per-row transformations on it and sends the rows back as packed
+RGB bytes. The parent process reassembles bands in order and streams them
+to the writer, so the writer sees an ordinary row generator.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from img_utils.bmp_reader_utils import MappedBMPReader
+from img_utils.pipeline_utils import REVERSES_ROWS, ROW_LOCAL, get_row_behavior
+from img_utils.row_utils import PackedRow, as_packed
+from img_utils.stream_utils import read_bmp_stream
+
+# Per-process state set up by _init_worker
+_worker = {}
+
+
+def execute_parallel(input_filename, transformations, image_writer, workers=None,
+                     band_rows=None):
+    """
+    Execute a pipeline on a BMP file using a process pool.
+
+    Transformations marked ROW_LOCAL (see pipeline_utils.set_row_behavior)
+    run inside the workers; transformations marked REVERSES_ROWS are applied
+    by reading the bands in reverse order, which gives the same result
+    because they commute with per-row work. If any transformation is
+    unmarked, or there is only one worker, the pipeline runs serially.
+
+    Workers are forked where the platform supports it, so curried
+    transformations (closures) work; with the spawn start method they must
+    be picklable.
+
+    Args:
+        input_filename: Path to BMP file
+        transformations: List of transformation functions
+        image_writer: A pre-configured writer function (e.g., write_bmp(24, 'out.bmp'))
+        workers: Number of worker processes (defaults to the CPU count)
+        band_rows: Rows per band (defaults to about 4 bands per worker)
+
+    Returns:
+        Whatever image_writer returns
+
+    Usage:
+        execute_parallel('huge.bmp', [grayscale, brightness(1.2)],
+                         write_bmp(24, 'out.bmp'), workers=32)
+    """
+    workers = workers or multiprocessing.cpu_count()
+    behaviors = [get_row_behavior(transform) for transform in transformations]
+
+    if workers <= 1 or any(b not in (ROW_LOCAL, REVERSES_ROWS) for b in behaviors):
+        stream = read_bmp_stream(input_filename)
+        for transform in transformations:
+            stream = transform(stream)
+        return image_writer(stream)
+
+    row_transforms = [t for t, b in zip(transformations, behaviors) if b == ROW_LOCAL]
+    reverse = behaviors.count(REVERSES_ROWS) % 2 == 1
+    return image_writer(_parallel_rows(input_filename, row_transforms, reverse,
+                                       workers, band_rows))
+
+
+def _parallel_rows(input_filename, row_transforms, reverse, workers, band_rows):
+    """Generator yielding metadata, then transformed rows assembled from bands."""
+    with MappedBMPReader(input_filename) as reader:
+        height = reader.height
+        metadata = _band_metadata(reader, height)
+
+    # Run the stages on the metadata alone so hints they add (mark_gray) survive
+    stream = iter([metadata])
+    for transform in row_transforms:
+        stream = transform(stream)
+    yield next(stream)
+
+    if band_rows is None:
+        band_rows = max(1, -(-height // (workers * 4)))
+    bands = [(start, min(start + band_rows, height)) for start in range(0, height, band_rows)]
+    if reverse:
+        bands.reverse()
+
+    context = None
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker,
+                             initargs=(input_filename, row_transforms)) as pool:
+        # Keep a bounded number of bands in flight so results don't pile up
+        pending = iter(bands)
+        futures = [pool.submit(_process_band, *band) for band in islice(pending, workers * 2)]
+        while futures:
+            band_data = futures.pop(0).result()
+            for band in islice(pending, 1):
+                futures.append(pool.submit(_process_band, *band))
+            if reverse:
+                band_data.reverse()
+            for data in band_data:
+                yield PackedRow(data)
+
+
+def _band_metadata(reader, height):
+    """Metadata as read_bmp_stream gives it, for a band of height rows."""
+    return {'width': reader.width, 'height': height, 'bit_depth': reader.bit_depth,
+            'top_down': reader.top_down}
+
+
+def _init_worker(input_filename, row_transforms):
+    """Open the input file once per worker process."""
+    _worker['reader'] = MappedBMPReader(input_filename)
+    _worker['transforms'] = row_transforms
+
+
+def _process_band(start, stop):
+    """Decode and transform rows [start, stop) and return them as packed bytes."""
+    reader = _worker['reader']
+
+    def band():
+        yield _band_metadata(reader, stop - start)
+        for i in range(start, stop):
+            yield reader.parse(reader.row(i))
+
+    stream = band()
+    for transform in _worker['transforms']:
+        stream = transform(stream)
+    next(stream)  # Metadata
+    return [as_packed(row).data for row in stream]
@@ -0,0 +1,797 @@
+"""
+Pipeline Utility Functions
+Helpers that let the pipeline inspect transformations and writers and pick
+a cheaper way to execute them.
+
+Transformations and writers are plain functions, so the information the
+pipeline needs is attached to them as attributes:
+
+- raw_block_op: set on a transformation that can also work directly on
+  raw, padded 24-bit BGR rows (see set_raw_block_op)
+- row_behavior: set on a transformation to say how it treats rows:
+  ROW_LOCAL (each output row depends only on the matching input row) or
+  REVERSES_ROWS (only reverses row order); see set_row_behavior
+- writer_config: set on a writer function returned by write_bmp/write_gif
+  to describe what it writes (see describe_writer)
+- point_op: set on a transformation that is a pure per-pixel color map
+  (see set_channel_lut and set_pixel_map), so that runs of them can be
+  fused into one pass (see fuse_point_ops)
+- geometry: set on a transformation that only moves or selects pixels
+  (flips, crops), so the planner can cancel and reorder it (see
+  set_geometry and plan_pipeline)
+"""
+
+import functools
+from itertools import chain
+
+from img_utils.bmp_reader_utils import (
+    calculate_row_size, read_bmp_headers, read_raw_blocks
+)
+from img_utils.bmp_writer_utils import write_24bit_raw_bmp
+from img_utils.row_utils import PackedRow, as_packed, gray_hint
+from img_utils.stream_utils import RowStream, prefetch, reverse_row_stream, write_behind
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Optional: vectorizes pixel maps that provide a NumPy version
+
+# Row behaviors understood by the parallel executor
+ROW_LOCAL = 'row_local'
+REVERSES_ROWS = 'reverses_rows'
+
+# Geometry kinds understood by plan_pipeline
+FLIP_HORIZONTAL = 'flip_horizontal'
+FLIP_VERTICAL = 'flip_vertical'
+SELECTS_PIXELS = 'selects_pixels'
+
+
+def set_raw_block_op(transform, raw_op):
+    """
+    Attach a raw-byte implementation to a transformation.
+
+    A raw op works on blocks of padded 24-bit BGR rows exactly as they are
+    stored in a BMP file, and must produce a block of the same layout.
+
+    Args:
+        transform: Transformation function (row generator -> row generator)
+        raw_op: Function (block, width, row_size) -> bytes-like block
+
+    Returns:
+        The same transformation, so this can wrap a return statement
+
+    Usage:
+        def flip_horizontal(row_generator):
+            ...
+        set_raw_block_op(flip_horizontal, raw_flip_horizontal)
+    """
+    transform.raw_block_op = raw_op
+    return transform
+
+
+def get_raw_block_op(transform):
+    """Get the raw-byte implementation of a transformation, or None."""
+    return getattr(transform, 'raw_block_op', None)
+
+
+def set_row_behavior(transform, behavior):
+    """
+    Declare how a transformation treats rows.
+
+    Args:
+        transform: Transformation function
+        behavior: ROW_LOCAL for stateless per-row transformations
+            (flip_horizontal, grayscale, brightness), REVERSES_ROWS for
+            transformations that only reverse row order (flip_vertical)
+
+    Returns:
+        The same transformation
+    """
+    if behavior not in (ROW_LOCAL, REVERSES_ROWS):
+        raise ValueError("Unknown row behavior: %r" % (behavior,))
+    transform.row_behavior = behavior
+    return transform
+
+
+def get_row_behavior(transform):
+    """Get the row behavior declared by set_row_behavior, or None."""
+    return getattr(transform, 'row_behavior', None)
+
+
+def describe_writer(writer, format, bit_depth=None, filename=None, **options):
+    """
+    Attach a description of what a writer function writes.
+
+    Args:
+        writer: Writer function (row generator -> None)
+        format: Output format name ('bmp' or 'gif')
+        bit_depth: Output bit depth, if the format has one
+        filename: Output file path
+        **options: Any other writer settings that affect the output
+
+    Returns:
+        The same writer function
+
+    Usage:
+        def write_bmp(bit_depth, filename):
+            def writer(row_generator):
+                ...
+            return describe_writer(writer, 'bmp', bit_depth, filename)
+    """
+    config = {'format': format, 'bit_depth': bit_depth, 'filename': filename}
+    config.update(options)
+    writer.writer_config = config
+    return writer
+
+
+def get_writer_config(writer):
+    """Get the description attached by describe_writer, or None."""
+    return getattr(writer, 'writer_config', None)
+
+
+def raw_identity(block, width, row_size):
+    """Raw op that passes BGR rows through unchanged."""
+    return block
+
+
+def raw_flip_horizontal(block, width, row_size):
+    """Raw op that mirrors each BGR row left-right."""
+    pixel_bytes = width * 3
+    out = bytearray(block)
+    for start in range(0, len(out), row_size):
+        # Reversing the bytes reverses pixel order and turns BGR into RGB
+        row = out[start:start + pixel_bytes][::-1]
+        row[0::3], row[2::3] = row[2::3], row[0::3]
+        out[start:start + pixel_bytes] = row
+    return out
+
+
+def raw_lut(table):
+    """
+    Create a raw op that maps every channel through a lookup table.
+
+    Args:
+        table: 256-entry lookup table (channel value -> new channel value)
+
+    Returns:
+        Raw op applying the table to whole blocks with bytes.translate; row
+        padding bytes are left zero
+    """
+    table = bytes(table)
+
+    def apply_lut(block, width, row_size):
+        out = bytes(block).translate(table)
+        pixel_bytes = width * 3
+        if pixel_bytes == row_size:
+            return out
+        out = bytearray(out)
+        padding = bytes(row_size - pixel_bytes)
+        for start in range(pixel_bytes, len(out), row_size):
+            out[start:start + len(padding)] = padding
+        return out
+
+    return apply_lut
+
+
+def plan_raw_passthrough(input_generator, transformations, image_writer):
+    """
+    Check whether a pipeline can run on raw 24-bit BGR rows end to end.
+
+    That is the case when the input is an unread RowStream over a 24-bit BMP
+    file, every transformation has a raw op and the writer writes a 24-bit
+    BMP.
+
+    Args:
+        input_generator: Row generator passed to the pipeline
+        transformations: List of transformation functions
+        image_writer: Writer function
+
+    Returns:
+        List of raw ops to apply in order, or None if the pipeline needs
+        decoded rows
+    """
+    if not isinstance(input_generator, RowStream) or input_generator.started:
+        return None
+    if input_generator.filename is None or input_generator.metadata.get('bit_depth') != 24:
+        return None
+
+    config = get_writer_config(image_writer)
+    if config is None or config['format'] != 'bmp' or config['bit_depth'] != 24:
+        return None
+
+    raw_ops = [get_raw_block_op(transform) for transform in transformations]
+    if any(raw_op is None for raw_op in raw_ops):
+        return None
+    return raw_ops
+
+
+def execute_raw_passthrough(input_filename, raw_ops, output_filename):
+    """
+    Copy a 24-bit BMP applying raw ops to its pixel rows, without decoding.
+
+    Rows are read in blocks with readinto(), passed through each raw op and
+    written with writelines(). The source's row order and top-down flag are
+    kept.
+
+    Args:
+        input_filename: Path to 24-bit BMP file
+        raw_ops: List of raw ops (block, width, row_size) -> block
+        output_filename: Path to output BMP file
+
+    Raises:
+        ValueError: If the input is not a 24-bit BMP
+    """
+    with open(input_filename, 'rb') as src:
+        pixel_offset, dib_header_size, width, height, bit_depth, top_down = read_bmp_headers(src)
+        if bit_depth != 24:
+            raise ValueError("Raw passthrough needs a 24-bit BMP, got %d-bit" % bit_depth)
+        row_size = calculate_row_size(width, bit_depth)
+        src.seek(pixel_offset)
+
+        def blocks():
+            for block in read_raw_blocks(src, height, row_size):
+                for raw_op in raw_ops:
+                    block = raw_op(block, width, row_size)
+                yield block
+
+        with open(output_filename, 'wb') as dst:
+            write_24bit_raw_bmp(dst, blocks(), width, height, top_down)
+
+
+def try_raw_passthrough(input_generator, transformations, image_writer):
+    """
+    Run a pipeline on raw 24-bit rows if plan_raw_passthrough allows it.
+
+    Intended as the first step of execute_transformation_pipeline: when it
+    returns True the output has been written and nothing else needs to run.
+
+    Args:
+        input_generator: Row generator passed to the pipeline
+        transformations: List of transformation functions
+        image_writer: Writer function
+
+    Returns:
+        True if the output was written, False if the pipeline must run normally
+    """
+    raw_ops = plan_raw_passthrough(input_generator, transformations, image_writer)
+    if raw_ops is None:
+        return False
+    execute_raw_passthrough(input_generator.filename, raw_ops,
+                            get_writer_config(image_writer)['filename'])
+    return True
+
+
+class PointOp:
+    """
+    Per-pixel color map in a canonical, fusable form.
+
+    A point op applies per-channel lookup tables (pre), then an optional
+    cross-channel pixel map, then more per-channel tables (post). Chaining
+    two point ops with then() always gives another point op of this form:
+    tables are composed into single 256-entry tables, and pixel maps are
+    composed into one function. Applying it therefore costs the same however
+    many stages were fused.
+
+    Tables run with bytes.translate. The pixel map runs through NumPy when
+    every fused pixel map has a NumPy version and NumPy is installed;
+    otherwise its results are memoized per distinct color, a lazily filled
+    3D LUT (a dense one would need 48 MB).
+    """
+
+    # Upper bound on memoized pixel map results
+    MEMO_LIMIT = 1 << 16
+
+    def __init__(self, pre=None, pixel_map=None, numpy_map=None, post=None, gray_output=False):
+        """
+        Initialize point op.
+
+        Args:
+            pre: (r_table, g_table, b_table) of 256-byte tables, or None
+            pixel_map: Function (R, G, B) -> (R, G, B), or None
+            numpy_map: Optional NumPy version of pixel_map, mapping an (N, 3)
+                uint8 array to an (N, 3) array of values 0-255
+            post: Tables applied after pixel_map, or None
+            gray_output: Whether pixel_map always returns gray (R == G == B)
+        """
+        self.pre = pre
+        self.pixel_map = pixel_map
+        self.numpy_map = numpy_map if pixel_map is not None else None
+        self.post = post if pixel_map is not None else None
+        self.gray_output = gray_output and pixel_map is not None
+        self._memo = {}
+
+    def then(self, other):
+        """
+        Get the point op equivalent to applying self, then other.
+
+        Args:
+            other: PointOp applied after this one
+
+        Returns:
+            New fused PointOp
+        """
+        if self.pixel_map is None:
+            return PointOp(_compose_tables(self.pre, other.pre), other.pixel_map,
+                           other.numpy_map, other.post, other.gray_output)
+        if other.pixel_map is None:
+            return PointOp(self.pre, self.pixel_map, self.numpy_map,
+                           _compose_tables(self.post, other.pre), self.gray_output)
+
+        middle = _compose_tables(self.post, other.pre)
+        first, second = self.pixel_map, other.pixel_map
+
+        def pixel_map(pixel):
+            pixel = first(pixel)
+            if middle is not None:
+                pixel = (middle[0][pixel[0]], middle[1][pixel[1]], middle[2][pixel[2]])
+            return second(pixel)
+
+        numpy_map = None
+        if self.numpy_map is not None and other.numpy_map is not None:
+            first_np, second_np = self.numpy_map, other.numpy_map
+
+            def fused_numpy(pixels):
+                pixels = np.asarray(first_np(pixels), dtype=np.uint8)
+                if middle is not None:
+                    pixels = _numpy_translate(pixels, middle)
+                return second_np(pixels)
+
+            numpy_map = fused_numpy
+
+        return PointOp(self.pre, pixel_map, numpy_map, other.post, other.gray_output)
+
+    def makes_gray(self):
+        """Whether every output pixel is gray, whatever the input."""
+        return self.gray_output and (self.post is None or _same_tables(self.post))
+
+    def keeps_gray(self):
+        """Whether gray input pixels are known to stay gray."""
+        if self.pixel_map is None:
+            return self.pre is None or _same_tables(self.pre)
+        return self.makes_gray()
+
+    def apply_pixel(self, pixel):
+        """Map one (R, G, B) tuple (reference implementation)."""
+        if self.pre is not None:
+            pixel = tuple(table[value] for table, value in zip(self.pre, pixel))
+        if self.pixel_map is not None:
+            pixel = tuple(self.pixel_map(pixel))
+            if self.post is not None:
+                pixel = tuple(table[value] for table, value in zip(self.post, pixel))
+        return pixel
+
+    def apply_row(self, row):
+        """
+        Map a whole row.
+
+        Args:
+            row: PackedRow or list of (R, G, B) tuples
+
+        Returns:
+            New PackedRow
+        """
+        source = as_packed(row).data
+        data = source
+        if self.pre is not None:
+            data = _translate_channels(data, self.pre)
+        if self.pixel_map is not None:
+            data = self._map_pixels(data)
+            if self.post is not None:
+                data = _translate_channels(data, self.post)
+        return PackedRow(data[:] if data is source else data)
+
+    def raw_op(self):
+        """
+        Get an equivalent raw op (see set_raw_block_op), or None.
+
+        Only a single table shared by all channels can run on raw BGR rows,
+        since channel order and row padding are then irrelevant.
+        """
+        if self.pixel_map is None and self.pre is not None and _same_tables(self.pre):
+            return raw_lut(self.pre[0])
+        return None
+
+    def _map_pixels(self, data):
+        """Apply the pixel map to interleaved RGB bytes."""
+        if self.numpy_map is not None and np is not None:
+            pixels = np.frombuffer(bytes(data), dtype=np.uint8).reshape(-1, 3)
+            mapped = np.asarray(self.numpy_map(pixels), dtype=np.uint8)
+            return bytearray(mapped.tobytes())
+
+        memo = self._memo
+        pixel_map = self.pixel_map
+        out = []
+        for pixel in zip(data[0::3], data[1::3], data[2::3]):
+            mapped = memo.get(pixel)
+            if mapped is None:
+                mapped = tuple(pixel_map(pixel))
+                if len(memo) >= self.MEMO_LIMIT:
+                    memo = self._memo = {}
+                memo[pixel] = mapped
+            out.append(mapped)
+        return bytearray(chain.from_iterable(out))
+
+
+def _compose_tables(first, second):
+    """Compose two (r, g, b) table triples (either may be None)."""
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return tuple(bytes(b[a[i]] for i in range(256)) for a, b in zip(first, second))
+
+
+def _same_tables(tables):
+    """Whether all three channel tables are identical."""
+    return tables[0] == tables[1] == tables[2]
+
+
+def _translate_channels(data, tables):
+    """Apply per-channel tables to interleaved RGB bytes."""
+    if _same_tables(tables):
+        return data.translate(tables[0])
+    out = bytearray(len(data))
+    for channel in range(3):
+        out[channel::3] = data[channel::3].translate(tables[channel])
+    return out
+
+
+def _numpy_translate(pixels, tables):
+    """Apply per-channel tables to an (N, 3) uint8 array."""
+    out = np.empty_like(pixels)
+    for channel in range(3):
+        out[:, channel] = np.frombuffer(tables[channel], dtype=np.uint8)[pixels[:, channel]]
+    return out
+
+
+def set_channel_lut(transform, r_table, g_table=None, b_table=None):
+    """
+    Declare a transformation as a per-channel lookup table.
+
+    Also marks it ROW_LOCAL, and when one table serves all channels, gives
+    it the matching raw op. When the tables differ the stage can add color
+    to a gray image, so the returned transformation drops the gray hint
+    (see row_utils.mark_gray) from its metadata; use it in place of the
+    original.
+
+    Args:
+        transform: Transformation function
+        r_table: 256-entry table for red (used for all channels if the
+            other two are omitted)
+        g_table: 256-entry table for green
+        b_table: 256-entry table for blue
+
+    Returns:
+        The same transformation, or a wrapper dropping the gray hint
+
+    Usage:
+        def brightness(factor):
+            def adjust(row_generator):
+                ...
+            return set_channel_lut(adjust, scale_table(factor))
+    """
+    r_table = bytes(r_table)
+    g_table = r_table if g_table is None else bytes(g_table)
+    b_table = r_table if b_table is None else bytes(b_table)
+    op = PointOp(pre=(r_table, g_table, b_table))
+    transform.point_op = op
+    if op.raw_op() is not None and get_raw_block_op(transform) is None:
+        set_raw_block_op(transform, op.raw_op())
+    set_row_behavior(transform, ROW_LOCAL)
+    return transform if op.keeps_gray() else _drop_gray_hint(transform)
+
+
+def set_pixel_map(transform, pixel_map, numpy_map=None, gray_output=None):
+    """
+    Declare a transformation as a cross-channel pixel map.
+
+    Also marks it ROW_LOCAL. Unless the pixel map is known to output gray,
+    the returned transformation drops the gray hint (see
+    row_utils.mark_gray) from its metadata; use it in place of the original.
+
+    Args:
+        transform: Transformation function
+        pixel_map: Function (R, G, B) -> (R, G, B) giving the output pixel
+        numpy_map: Optional NumPy version of pixel_map ((N, 3) uint8 array
+            -> (N, 3) array), used when NumPy is installed
+        gray_output: Whether pixel_map always returns gray pixels (None:
+            only if it is luminance)
+
+    Returns:
+        The same transformation, or a wrapper dropping the gray hint
+
+    Usage:
+        set_pixel_map(grayscale, luminance, luminance_numpy)
+    """
+    if gray_output is None:
+        gray_output = pixel_map is luminance
+    op = PointOp(pixel_map=pixel_map, numpy_map=numpy_map, gray_output=gray_output)
+    transform.point_op = op
+    set_row_behavior(transform, ROW_LOCAL)
+    return transform if op.keeps_gray() else _drop_gray_hint(transform)
+
+
+def _drop_gray_hint(transform):
+    """Wrap a transformation so that its metadata never carries the gray hint."""
+    @functools.wraps(transform)
+    def without_hint(row_generator):
+        stream = transform(row_generator)
+        yield _without_gray_hint(next(stream))
+        yield from stream
+
+    return without_hint
+
+
+def _without_gray_hint(metadata):
+    """Get metadata without the gray hint (the same dictionary if it has none)."""
+    if 'color_space' not in metadata:
+        return metadata
+    metadata = dict(metadata)
+    del metadata['color_space']
+    return metadata
+
+
+def get_point_op(transform):
+    """Get the PointOp declared by set_channel_lut/set_pixel_map, or None."""
+    return getattr(transform, 'point_op', None)
+
+
+def scale_table(factor):
+    """Lookup table for min(255, int(value * factor)), as used by brightness."""
+    return bytes(min(255, int(value * factor)) for value in range(256))
+
+
+def luminance(pixel):
+    """Pixel map to gray: int(0.299*R + 0.587*G + 0.114*B) in all channels."""
+    r, g, b = pixel
+    gray = int(0.299 * r + 0.587 * g + 0.114 * b)
+    return (gray, gray, gray)
+
+
+def luminance_numpy(pixels):
+    """NumPy version of luminance for an (N, 3) uint8 array."""
+    gray = (0.299 * pixels[:, 0] + 0.587 * pixels[:, 1] + 0.114 * pixels[:, 2]).astype(np.uint8)
+    return np.repeat(gray[:, np.newaxis], 3, axis=1)
+
+
+def fuse_point_ops(transformations):
+    """
+    Replace each run of consecutive point-op transformations with one stage.
+
+    The fused stage maps every row once through the combined PointOp. It
+    yields the metadata the original stages would have produced (each stage
+    is run on the metadata alone, so hints like mark_gray survive), and
+    keeps the row type: PackedRows in, PackedRows out; tuple rows in, tuple
+    rows out. Transformations without a point op are left where they are.
+
+    Args:
+        transformations: List of transformation functions
+
+    Returns:
+        New list of transformation functions
+
+    Usage:
+        transformations = fuse_point_ops([grayscale, brightness(1.2), brightness(0.9)])
+        # -> one stage doing a pixel map and a single lookup table per row
+    """
+    fused = []
+    run = []
+    for transform in list(transformations) + [None]:
+        if transform is not None and get_point_op(transform) is not None:
+            run.append(transform)
+            continue
+        if len(run) > 1:
+            fused.append(_fused_transform(run))
+        else:
+            fused.extend(run)
+        run = []
+        if transform is not None:
+            fused.append(transform)
+    return fused
+
+
+def _fused_transform(run):
+    """Build one transformation applying a run of point-op transformations."""
+    op = get_point_op(run[0])
+    for transform in run[1:]:
+        op = op.then(get_point_op(transform))
+
+    def fused(row_generator):
+        metadata = next(row_generator)
+        stream = iter([metadata])
+        for transform in run:
+            stream = transform(stream)
+        fused_metadata = next(stream)
+        if not (op.makes_gray() or (gray_hint(metadata) and op.keeps_gray())):
+            fused_metadata = _without_gray_hint(fused_metadata)
+        yield fused_metadata
+
+        apply_row = op.apply_row
+        for row in row_generator:
+            out = apply_row(row)
+            yield out if isinstance(row, PackedRow) else out.to_pixels()
+
+    fused.point_op = op
+    if op.raw_op() is not None:
+        set_raw_block_op(fused, op.raw_op())
+    return set_row_behavior(fused, ROW_LOCAL)
+
+
+def set_geometry(transform, kind):
+    """
+    Declare a transformation as a geometric operation.
+    
+    Args:
+        transform: Transformation function
+        kind: FLIP_HORIZONTAL or FLIP_VERTICAL for the flips (which also
+            sets the matching row behavior), or SELECTS_PIXELS for
+            operations whose output pixels are unchanged copies of input
+            pixels, such as crops or nearest-neighbour downscaling
+            
+    Returns:
+        The same transformation
+        
+    Usage:
+        set_geometry(flip_horizontal, FLIP_HORIZONTAL)
+        set_geometry(flip_vertical, FLIP_VERTICAL)
+    """
+    if kind not in (FLIP_HORIZONTAL, FLIP_VERTICAL, SELECTS_PIXELS):
+        raise ValueError("Unknown geometry: %r" % (kind,))
+    transform.geometry = kind
+    if kind == FLIP_HORIZONTAL:
+        set_row_behavior(transform, ROW_LOCAL)
+    elif kind == FLIP_VERTICAL:
+        set_row_behavior(transform, REVERSES_ROWS)
+    return transform
+
+
+def get_geometry(transform):
+    """Get the geometry declared by set_geometry, or None."""
+    return getattr(transform, 'geometry', None)
+
+
+def plan_pipeline(transformations):
+    """
+    Rewrite a transformation list into an equivalent one that does less work.
+    
+    Transformations without a point op or geometry are barriers: nothing
+    moves across them. Between barriers:
+    - point ops commute with flips and pixel selections, so they are moved
+      after them (working on fewer pixels after a crop) and fused into one
+      stage (see fuse_point_ops)
+    - flips with no pixel selection between them are reduced to their
+      parity, so double flips cancel
+    - a vertical flip with only ROW_LOCAL transformations before it is
+      taken out of the list: reading the source in reverse has the same
+      effect. One with only ROW_LOCAL transformations after it is moved to
+      the end, where the writer can absorb it (see execute_planned).
+    
+    Args:
+        transformations: List of transformation functions, in order
+        
+    Returns:
+        Tuple of (transformations, reverse_rows), where reverse_rows says
+        whether the source rows must be read in reverse (see execute_planned)
+        
+    Usage:
+        plan_pipeline([flip_horizontal, grayscale, flip_horizontal, flip_vertical])
+        # -> ([grayscale], True)
+    """
+    planned = []
+    block = []
+    for transform in list(transformations) + [None]:
+        if transform is not None and (get_point_op(transform) is not None
+                                      or get_geometry(transform) is not None):
+            block.append(transform)
+            continue
+        planned.extend(_plan_block(block))
+        block = []
+        if transform is not None:
+            planned.append(transform)
+    
+    reverse_rows = False
+    final_flip = None
+    i = 0
+    while i < len(planned):
+        transform = planned[i]
+        if get_geometry(transform) == FLIP_VERTICAL:
+            if all(get_row_behavior(t) == ROW_LOCAL for t in planned[:i]):
+                del planned[i]
+                reverse_rows = not reverse_rows
+                continue
+            if all(get_row_behavior(t) == ROW_LOCAL for t in planned[i + 1:]):
+                del planned[i]
+                final_flip = transform if final_flip is None else None
+                continue
+        i += 1
+    if final_flip is not None:
+        planned.append(final_flip)
+    return planned, reverse_rows
+
+
+def _plan_block(block):
+    """Plan a run of point ops and geometric transformations (no barriers)."""
+    point_ops = [t for t in block if get_geometry(t) is None]
+    geometry = []
+    flips = {FLIP_HORIZONTAL: None, FLIP_VERTICAL: None}
+    
+    def flush_flips():
+        for flip in flips.values():
+            if flip is not None:
+                geometry.append(flip)
+        flips[FLIP_HORIZONTAL] = flips[FLIP_VERTICAL] = None
+    
+    for transform in block:
+        kind = get_geometry(transform)
+        if kind in flips:
+            # A second flip of the same kind cancels the first
+            flips[kind] = transform if flips[kind] is None else None
+        elif kind == SELECTS_PIXELS:
+            flush_flips()
+            geometry.append(transform)
+    flush_flips()
+    return geometry + fuse_point_ops(point_ops)
+
+
+def execute_planned(input_generator, transformations, image_writer, prefetch_depth=None,
+                    write_behind_depth=None):
+    """
+    Plan a pipeline with plan_pipeline and run it.
+    
+    Vertical flips are folded into the writer's top_down flag when the
+    writer was described with honors_top_down=True (it then writes rows in
+    the order given and reads the orientation from metadata['top_down']):
+    a flip the planner left at the end of the list, or a reversed source
+    when every remaining transformation is ROW_LOCAL. Otherwise a reversed
+    source is read backwards: by seeking for a RowStream, through a
+    temporary file spill for other generators.
+    
+    On slow or network filesystems, prefetch_depth reads rows ahead on a
+    background thread (see prefetch) and write_behind_depth runs the writer
+    on another (see write_behind), so I/O overlaps with the transformations.
+    
+    Args:
+        input_generator: Row generator (ideally a RowStream from read_bmp_stream)
+        transformations: List of transformation functions
+        image_writer: Writer function
+        prefetch_depth: Rows to read ahead on a thread (None to read inline)
+        write_behind_depth: Rows queued for a writer thread (None to write inline)
+        
+    Returns:
+        Whatever image_writer returns
+    """
+    transformations, reverse_rows = plan_pipeline(transformations)
+    
+    if not reverse_rows and try_raw_passthrough(input_generator, transformations, image_writer):
+        return None
+    
+    config = get_writer_config(image_writer) or {}
+    toggle_top_down = False
+    if config.get('honors_top_down'):
+        if transformations and get_geometry(transformations[-1]) == FLIP_VERTICAL:
+            transformations = transformations[:-1]
+            toggle_top_down = True
+        if reverse_rows and all(get_row_behavior(t) == ROW_LOCAL for t in transformations):
+            reverse_rows = False
+            toggle_top_down = not toggle_top_down
+    
+    stream = input_generator
+    if reverse_rows:
+        stream = reverse_row_stream(stream)
+    if prefetch_depth:
+        stream = prefetch(stream, prefetch_depth)
+    if write_behind_depth:
+        image_writer = write_behind(image_writer, write_behind_depth)
+    for transform in transformations:
+        stream = transform(stream)
+    if toggle_top_down:
+        stream = _toggle_top_down(stream)
+    return image_writer(stream)
+
+
+def _toggle_top_down(row_generator):
+    """Generator that flips metadata['top_down'] and passes the rows through."""
+    metadata = dict(next(row_generator))
+    metadata['top_down'] = not metadata.get('top_down', False)
+    yield metadata
+    yield from row_generator
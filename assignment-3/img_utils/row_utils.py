@@ -0,0 +1,286 @@
+"""
+Row Utility Functions
+Compact row representation for the pixel pipeline.
+
+A row in the generator protocol is normally a list of (R, G, B) tuples,
+which costs a list slot plus a tuple object per pixel (~70 bytes). PackedRow
+holds the same pixels as interleaved RGB bytes (3 bytes per pixel) while
+still behaving like a sequence of (R, G, B) tuples, so code written for
+tuple rows keeps working when handed a PackedRow.
+"""
+
+from itertools import chain
+
+
+class PackedRow:
+    """
+    Row of pixels stored as interleaved RGB bytes in a bytearray.
+
+    Iterating or indexing a PackedRow yields (R, G, B) tuples, so it can be
+    used wherever a list of tuples is expected. Transformations that know
+    about PackedRow can work on the bytes directly via the methods below.
+
+    Usage:
+        row = PackedRow.from_pixels([(255, 0, 0), (0, 0, 255)])
+        row[0]               # (255, 0, 0)
+        row.flipped()        # pixels in reverse order
+        row.translate(lut)   # 256-entry lookup table applied to every channel
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data=b''):
+        """
+        Initialize packed row.
+
+        Args:
+            data: Interleaved RGB bytes (bytearray is used as-is, anything
+                else is copied into a new bytearray)
+        """
+        self.data = data if isinstance(data, bytearray) else bytearray(data)
+
+    @classmethod
+    def from_pixels(cls, pixels):
+        """Create a packed row from an iterable of (R, G, B) tuples."""
+        if isinstance(pixels, PackedRow):
+            return cls(pixels.data[:])
+        return cls(bytearray(chain.from_iterable(pixels)))
+
+    @classmethod
+    def from_bgr(cls, data):
+        """Create a packed row from BMP-style BGR bytes (no padding)."""
+        rgb = bytearray(data)
+        rgb[0::3], rgb[2::3] = rgb[2::3], rgb[0::3]
+        return cls(rgb)
+
+    def __len__(self):
+        return len(self.data) // 3
+
+    def __iter__(self):
+        data = self.data
+        return zip(data[0::3], data[1::3], data[2::3])
+
+    def __reversed__(self):
+        return iter(self.flipped())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return PackedRow(self.data[start * 3:max(start, stop) * 3])
+            return PackedRow.from_pixels(list(self)[index])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("pixel index out of range")
+        offset = index * 3
+        return tuple(self.data[offset:offset + 3])
+
+    def __setitem__(self, index, pixel):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("pixel index out of range")
+        offset = index * 3
+        self.data[offset:offset + 3] = bytes(pixel)
+
+    def __eq__(self, other):
+        if isinstance(other, PackedRow):
+            return self.data == other.data
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return 'PackedRow(%d pixels)' % len(self)
+
+    def to_pixels(self):
+        """Get the row as a list of (R, G, B) tuples."""
+        return list(self)
+
+    def to_bgr(self):
+        """Get the row as BMP-style BGR bytes (no padding)."""
+        bgr = self.data[:]
+        bgr[0::3], bgr[2::3] = bgr[2::3], bgr[0::3]
+        return bgr
+
+    def flipped(self):
+        """Get a copy of the row with pixels in reverse order."""
+        # Reversing the bytes reverses pixel order and turns RGB into BGR
+        data = self.data[::-1]
+        data[0::3], data[2::3] = data[2::3], data[0::3]
+        return PackedRow(data)
+
+    def translate(self, table):
+        """
+        Map every channel value through a lookup table.
+
+        Args:
+            table: 256-byte lookup table (bytes or bytearray)
+
+        Returns:
+            New PackedRow with data.translate(table) applied
+        """
+        return PackedRow(self.data.translate(table))
+
+    def map_channels(self, r_table, g_table, b_table):
+        """
+        Map each channel through its own lookup table.
+
+        Args:
+            r_table: 256-entry lookup table for red
+            g_table: 256-entry lookup table for green
+            b_table: 256-entry lookup table for blue
+
+        Returns:
+            New PackedRow with the tables applied
+        """
+        data = self.data
+        out = bytearray(len(data))
+        out[0::3] = data[0::3].translate(bytes(r_table))
+        out[1::3] = data[1::3].translate(bytes(g_table))
+        out[2::3] = data[2::3].translate(bytes(b_table))
+        return PackedRow(out)
+
+    def grayscale(self):
+        """
+        Get a grayscale copy using the luminance formula.
+        Formula: int(0.299*R + 0.587*G + 0.114*B), written to all channels.
+        """
+        data = self.data
+        gray = bytes([int(0.299 * r + 0.587 * g + 0.114 * b)
+                      for r, g, b in zip(data[0::3], data[1::3], data[2::3])])
+        out = bytearray(len(data))
+        out[0::3] = gray
+        out[1::3] = gray
+        out[2::3] = gray
+        return PackedRow(out)
+
+
+def as_packed(row):
+    """
+    Adapt a row to a PackedRow.
+
+    Args:
+        row: PackedRow (returned unchanged) or list of (R, G, B) tuples
+
+    Returns:
+        PackedRow holding the same pixels
+    """
+    if isinstance(row, PackedRow):
+        return row
+    return PackedRow.from_pixels(row)
+
+
+def as_pixels(row):
+    """
+    Adapt a row to a list of (R, G, B) tuples.
+
+    Args:
+        row: PackedRow or list of (R, G, B) tuples (returned unchanged)
+
+    Returns:
+        List of (R, G, B) tuples
+    """
+    if isinstance(row, PackedRow):
+        return row.to_pixels()
+    return row
+
+
+def packed_rows(row_generator):
+    """
+    Generator adapter that turns a tuple-row stream into a PackedRow stream.
+
+    Args:
+        row_generator: Generator yielding metadata, then rows
+    """
+    yield next(row_generator)
+    for row in row_generator:
+        yield as_packed(row)
+
+
+def tuple_rows(row_generator):
+    """
+    Generator adapter that turns a PackedRow stream into a tuple-row stream,
+    for stages that index or mutate rows as lists.
+
+    Args:
+        row_generator: Generator yielding metadata, then rows
+    """
+    yield next(row_generator)
+    for row in row_generator:
+        yield as_pixels(row)
+
+
+# Metadata hint: 'color_space' is set to COLOR_SPACE_GRAY by stages whose
+# output rows all have R == G == B, so writers can skip gray detection
+COLOR_SPACE_GRAY = 'gray'
+
+
+def mark_gray(metadata):
+    """
+    Get a copy of a metadata dictionary tagged as grayscale.
+
+    Usage:
+        def grayscale(row_generator):
+            yield mark_gray(next(row_generator))
+            ...
+    """
+    metadata = dict(metadata)
+    metadata['color_space'] = COLOR_SPACE_GRAY
+    return metadata
+
+
+def gray_hint(metadata):
+    """
+    Read the grayscale hint from a metadata dictionary.
+
+    Stages that may add color to a gray stream must drop the hint
+    (metadata.pop('color_space', None)) rather than pass it through.
+    Writers still check every row before trusting it (see collect_gray).
+
+    Returns:
+        True if the stream is marked gray, None if unknown (detect it)
+    """
+    return True if metadata.get('color_space') == COLOR_SPACE_GRAY else None
+
+
+def collect_gray(rows):
+    """
+    Check a gray hint against every row, keeping the gray values.
+
+    An untagged stage can pass a gray hint through while adding color, so
+    writers that trust the hint must still look at each row.
+
+    Args:
+        rows: Iterable of rows the hint claims are gray
+
+    Returns:
+        (gray_rows, None) with each row's gray values as bytes if every row
+        is gray, otherwise (None, rows) with all the rows as lists of
+        (R, G, B) tuples or PackedRows, the gray ones rebuilt from their values
+    """
+    rows = iter(rows)
+    gray_rows = []
+    for row in rows:
+        if not is_gray_row(row):
+            pixel_rows = [[(value, value, value) for value in gray_row] for gray_row in gray_rows]
+            pixel_rows.append(row)
+            pixel_rows.extend(rows)
+            return None, pixel_rows
+        gray_rows.append(gray_channel(row))
+    return gray_rows, None
+
+
+def is_gray_row(row):
+    """Check whether every pixel of a row has R == G == B."""
+    data = row.data if isinstance(row, PackedRow) else bytes(chain.from_iterable(row))
+    return data[0::3] == data[1::3] == data[2::3]
+
+
+def gray_channel(row):
+    """Get the red channel of a gray row as bytes (one value per pixel)."""
+    if isinstance(row, PackedRow):
+        return bytes(row.data[0::3])
+    return bytes(pixel[0] for pixel in row)
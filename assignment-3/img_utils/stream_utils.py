@@ -0,0 +1,363 @@
+"""
+Row Stream Utility Functions
+Helpers for working with the generator protocol used throughout the pipeline:
+a metadata dictionary first, then rows of RGB tuples.
+"""
+
+import queue
+import tempfile
+import threading
+from itertools import chain
+
+from img_utils.bmp_reader_utils import (
+    BMPRowReader, calculate_row_size, read_bmp_headers, read_color_table,
+    read_rows_backwards
+)
+from img_utils.row_utils import PackedRow
+
+
+class RowStream:
+    """
+    Row generator that can also replay its rows in reverse order.
+
+    Iterating a RowStream follows the usual protocol (metadata first, then
+    rows), so it can be passed anywhere a row generator is expected. Sources
+    that know how to read backwards, such as a seekable BMP file, supply
+    reverse_rows so that transformations like flip_vertical can ask for
+    reversed rows instead of buffering the whole image.
+    """
+
+    def __init__(self, metadata, rows, reverse_rows=None, filename=None):
+        """
+        Initialize row stream.
+
+        Args:
+            metadata: Metadata dictionary ('width', 'height', 'bit_depth', ...)
+            rows: Zero-argument function returning an iterator of rows in order
+            reverse_rows: Optional zero-argument function returning an iterator
+                of rows in reverse order (spilled to a temp file if omitted)
+            filename: Path of the file the rows are decoded from, if any
+        """
+        self.metadata = metadata
+        self._rows = rows
+        self._reverse_rows = reverse_rows
+        self.filename = filename
+        self._iterator = None
+        self._metadata_sent = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._metadata_sent:
+            self._metadata_sent = True
+            return self.metadata
+        if self._iterator is None:
+            self._iterator = iter(self._rows())
+        return next(self._iterator)
+
+    @property
+    def started(self):
+        """Whether anything (metadata or rows) has been read from the stream."""
+        return self._metadata_sent
+
+    def reversed_rows(self):
+        """
+        Get the stream's rows in reverse order.
+
+        Must be called before any rows have been read from the stream; the
+        metadata may already have been consumed.
+
+        Returns:
+            Iterator over rows, last row first
+
+        Raises:
+            RuntimeError: If forward iteration over the rows has started
+        """
+        if self._iterator is not None:
+            raise RuntimeError("Rows have already been read from this stream")
+        self._metadata_sent = True
+        self._iterator = iter(())
+        if self._reverse_rows is not None:
+            return iter(self._reverse_rows())
+        return spill_reversed(self._rows(), self.metadata['width'])
+
+
+def read_bmp_stream(filename):
+    """
+    Open a BMP file as a RowStream that can be read forwards or backwards.
+
+    The file is only opened to read headers here; rows are read lazily when
+    the stream is iterated. Reversed rows are read by seeking backwards
+    through the file, never by buffering the image.
+
+    Args:
+        filename: Path to BMP file
+
+    Returns:
+        RowStream yielding {'width', 'height', 'bit_depth', 'top_down'} and
+        then rows in file order (bottom-to-top for standard BMPs, top-to-bottom
+        when top_down is True)
+    """
+    with open(filename, 'rb') as f:
+        pixel_offset, dib_header_size, width, height, bit_depth, top_down = read_bmp_headers(f)
+    metadata = {'width': width, 'height': height, 'bit_depth': bit_depth, 'top_down': top_down}
+
+    def rows():
+        return _read_bmp_rows(filename, reverse=False)
+
+    def reverse_rows():
+        return _read_bmp_rows(filename, reverse=True)
+
+    return RowStream(metadata, rows, reverse_rows, filename)
+
+
+def _read_bmp_rows(filename, reverse):
+    """Generator over the decoded rows of a BMP file in file or reverse order."""
+    with open(filename, 'rb') as f:
+        pixel_offset, dib_header_size, width, height, bit_depth, top_down = read_bmp_headers(f)
+        color_table = read_color_table(f, dib_header_size, bit_depth)
+        row_size = calculate_row_size(width, bit_depth)
+        f.seek(pixel_offset)
+        reader = BMPRowReader(f, width, height, bit_depth, color_table, row_size, top_down)
+        if reverse:
+            yield from reader.read_rows_reversed()
+        else:
+            yield from reader.read_rows()
+
+
+def reverse_row_stream(row_generator):
+    """
+    Generator that yields metadata, then the rows of row_generator in reverse.
+
+    Runs in constant memory: if the source is a RowStream it is asked for its
+    rows in reverse (a seek-based read for BMP files), otherwise the rows are
+    spilled to a temporary file and read back from the end.
+
+    Args:
+        row_generator: Generator yielding metadata, then rows
+
+    Usage:
+        def flip_vertical(row_generator):
+            return reverse_row_stream(row_generator)
+    """
+    metadata = next(row_generator)
+    yield metadata
+    if isinstance(row_generator, RowStream):
+        yield from row_generator.reversed_rows()
+    else:
+        yield from spill_reversed(row_generator, metadata['width'])
+
+
+def spill_reversed(rows, width):
+    """
+    Generator that yields rows in reverse order without holding them in RAM.
+
+    Each row is written to an anonymous temporary file as packed 24-bit
+    pixels (3 bytes per pixel instead of a list of tuples), then the file is
+    read back in blocks from the end.
+
+    Args:
+        rows: Iterable of rows (RGB tuples with channel values 0-255, or PackedRows)
+        width: Number of pixels in each row
+
+    Yields:
+        List of (R, G, B) tuples for each row, last row first
+    """
+    row_size = width * 3
+    with tempfile.TemporaryFile() as spill:
+        count = 0
+        for row in rows:
+            spill.write(_pack_bgr(row))
+            count += 1
+        if count == 0 or row_size == 0:
+            for _ in range(count):
+                yield []
+            return
+        yield from read_rows_backwards(spill, 0, count, width, 24, None, row_size)
+
+
+def _pack_bgr(row):
+    """Pack a row of RGB tuples (or a PackedRow) into BMP-style BGR bytes."""
+    if isinstance(row, PackedRow):
+        return row.to_bgr()
+    data = bytearray(chain.from_iterable(row))
+    data[0::3], data[2::3] = data[2::3], data[0::3]
+    return data
+
+
+# Markers passed through fan-out queues after the last row
+_END = object()
+_SOURCE_FAILED = object()
+
+
+def fan_out(row_generator, writers, max_queued_rows=64):
+    """
+    Feed one decoded and transformed stream to several writers.
+
+    The source is iterated once. Each writer runs on its own thread and
+    reads from a bounded queue, so a slow writer holds back the source
+    rather than letting rows pile up. Rows are shared between writers, so
+    writers must not modify them.
+
+    Args:
+        row_generator: Generator yielding metadata, then rows
+        writers: List of writer functions (e.g. write_bmp(8, 'a.bmp'))
+        max_queued_rows: Maximum number of rows waiting for each writer
+
+    Returns:
+        List of the writers' return values, in order
+
+    Raises:
+        The first exception raised by the source or any writer, after all
+        writer threads have finished
+
+    Usage:
+        fan_out(pipeline(read_bmp('photo.bmp')),
+                [write_bmp(8, 'out8.bmp'), write_bmp(24, 'out24.bmp'), write_gif('out.gif')])
+    """
+    queues = [queue.Queue(maxsize=max_queued_rows) for _ in writers]
+    results = [None] * len(writers)
+    errors = [None] * len(writers)
+    threads = [threading.Thread(target=_run_fan_out_writer,
+                                args=(writer, rows_queue, results, errors, i), daemon=True)
+               for i, (writer, rows_queue) in enumerate(zip(writers, queues))]
+    for thread in threads:
+        thread.start()
+
+    end = _END
+    try:
+        for item in row_generator:
+            for rows_queue in queues:
+                rows_queue.put(item)
+    except BaseException:
+        end = _SOURCE_FAILED
+        raise
+    finally:
+        for rows_queue in queues:
+            rows_queue.put(end)
+        for thread in threads:
+            thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
+
+
+def _run_fan_out_writer(writer, rows_queue, results, errors, index):
+    """Run one fan-out writer, then drain its queue so the source never blocks."""
+    try:
+        results[index] = writer(_queued_rows(rows_queue))
+    except BaseException as exc:
+        errors[index] = exc
+    while True:
+        item = rows_queue.get()
+        if item is _END or item is _SOURCE_FAILED:
+            break
+
+
+def _queued_rows(rows_queue):
+    """Generator over the items put into a fan-out queue."""
+    while True:
+        item = rows_queue.get()
+        if item is _END:
+            rows_queue.put(_END)  # Leave the marker for the final drain
+            return
+        if item is _SOURCE_FAILED:
+            rows_queue.put(_SOURCE_FAILED)
+            raise RuntimeError("The source stream failed while writing")
+        yield item
+
+
+def prefetch(row_generator, depth=64):
+    """
+    Generator that reads row_generator ahead on a background thread.
+
+    Up to depth rows are decoded ahead of the consumer and held in a bounded
+    queue, so disk reads (and any work done by the source) overlap with the
+    transformations and writer downstream. Exceptions raised by the source
+    are re-raised in the consumer.
+
+    Args:
+        row_generator: Generator yielding metadata, then rows
+        depth: Maximum number of rows read ahead
+
+    Usage:
+        execute_transformation_pipeline(prefetch(read_bmp('photo.bmp')), ...)
+    """
+    rows_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    thread = threading.Thread(target=_run_prefetch, args=(row_generator, rows_queue, stop),
+                              daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = rows_queue.get()
+            if item is _END:
+                return
+            if isinstance(item, _PrefetchError):
+                raise item.error
+            yield item
+    finally:
+        # Unblock the reader if the consumer stopped early
+        stop.set()
+        while thread.is_alive():
+            try:
+                rows_queue.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+class _PrefetchError:
+    """Queue item carrying an exception raised by a prefetched source."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _run_prefetch(row_generator, rows_queue, stop):
+    """Read row_generator into rows_queue until it ends or stop is set."""
+    try:
+        for item in row_generator:
+            if stop.is_set():
+                return
+            rows_queue.put(item)
+    except BaseException as exc:
+        rows_queue.put(_PrefetchError(exc))
+        return
+    finally:
+        close = getattr(row_generator, 'close', None)
+        if close is not None and stop.is_set():
+            close()
+    rows_queue.put(_END)
+
+
+def write_behind(image_writer, depth=64):
+    """
+    Wrap a writer so that it runs on a background thread.
+
+    The wrapped writer is fed through a bounded queue of depth rows (see
+    fan_out), so encoding and disk writes overlap with the transformations
+    producing the rows, and a slow disk holds the pipeline back by at most
+    depth rows. Any writer description (describe_writer) is kept.
+
+    Args:
+        image_writer: Writer function (e.g. write_bmp(24, 'out.bmp'))
+        depth: Maximum number of rows waiting for the writer
+
+    Returns:
+        Writer function with the same result as image_writer
+
+    Usage:
+        execute_transformation_pipeline(read_bmp('photo.bmp'), [grayscale],
+                                        write_behind(write_bmp(8, 'out.bmp')))
+    """
+    def writer(row_generator):
+        return fan_out(row_generator, [image_writer], max_queued_rows=depth)[0]
+
+    config = getattr(image_writer, 'writer_config', None)
+    if config is not None:
+        writer.writer_config = config
+    return writer
@@ -6,6 +6,19 @@ def execute_transformation_pipeline(input_generator, transformations, image_writ
     
     This is a low-level function that directly executes the pipeline.
     
+    Note: Format-preserving 24-bit jobs can skip decoding entirely.
+    img_utils.pipeline_utils.try_raw_passthrough runs the pipeline on raw
+    BGR bytes when the input is a RowStream (read_bmp_stream), every
+    transformation has a raw op and the writer is described as a 24-bit BMP.
+    Runs of per-pixel color maps (brightness, grayscale) can be merged into
+    one stage first with img_utils.pipeline_utils.fuse_point_ops, and
+    img_utils.pipeline_utils.execute_planned also cancels double flips and
+    folds flip_vertical into the read order or the writer's top_down flag.
+    Its prefetch_depth and write_behind_depth options move reading and
+    writing onto background threads so that I/O overlaps with compute.
+    From asyncio code, img_utils.async_utils.arun_pipeline runs the same
+    pipeline in an executor without blocking the event loop.
+    
     Args:
         input_generator: A generator yielding input data (from read_bmp)
         transformations: A list of transformation functions
@@ -29,6 +42,12 @@ def compose(*functions):
     Example:
         compose(f, g, h)(x) is equivalent to f(g(h(x)))
     
+    Note: When composing transformations, the list can first be simplified
+    with img_utils.pipeline_utils.plan_pipeline([h, g, f]), which cancels
+    double flips and fuses point operations. Stages lifted with
+    img_utils.chunk_utils.chunked take blocks of rows instead of single
+    rows and compose the same way.
+    
     Args:
         *functions: Variable number of functions to compose
         
@@ -14,6 +14,10 @@ def from_file(input_filename):
     This pattern is useful when you want to apply multiple different transformations
     to the same source image.
     
+    Note: img_utils.cache_utils.cached_from_file is a variant that records
+    decoded and intermediate stages in a StageCache, so transformation lists
+    sharing a prefix resume from the recorded stage.
+    
     Args:
         input_filename: Source image file path
     
@@ -33,6 +37,10 @@ def from_file_with_transforms(input_filename, transformations):
     This pattern is useful when you want to save the same transformation
     to multiple output formats or locations.
     
+    Note: Each call re-reads and re-transforms the source. To export several
+    formats from a single decode, img_utils.stream_utils.fan_out feeds one
+    transformed stream to a list of writers.
+    
     Args:
         input_filename: Source image file path
         transformations: List of transformation functions
@@ -52,6 +60,9 @@ def with_transforms(transformations):
     
     This pattern is useful when you want to apply the same transformation
     to multiple different images (batch processing).
+    
+    Note: img_utils.cache_utils.cached_with_transforms is a drop-in variant
+    that skips runs whose output is already in an on-disk result cache.
        
     Args:
         transformations: List of transformation functions
@@ -0,0 +1,1101 @@
+# test_img_utils.py
+# Unit tests for the img_utils helpers
+# Run from assignment-3: python -m unittest test_img_utils
+
+import asyncio
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from img_utils import pipeline_utils as P
+from img_utils.async_utils import aread_bmp, arun_pipeline, atransform, awrite
+from img_utils.batch_utils import process_batch
+from img_utils.bmp_reader_utils import MappedBMPReader, parse_row, parse_rows
+from img_utils.bmp_writer_utils import get_palette_index, get_quantizer, write_24bit_bmp, \
+    write_8bit_bmp, write_8bit_bmp_streaming
+from img_utils.cache_utils import StageCache, transform_fingerprint
+from img_utils.chunk_utils import chunk_rows, chunked_pipeline, unchunk_rows
+from img_utils.gif_utils import convert_to_gif, write_animated_gif, write_gif_streaming
+from img_utils.palette_utils import build_shared_palette, load_palette, save_palette
+from img_utils.parallel_utils import execute_parallel
+from img_utils.row_utils import PackedRow, gray_hint, mark_gray
+from img_utils.stream_utils import fan_out, prefetch, read_bmp_stream, reverse_row_stream
+
+try:
+    from PIL import Image, ImageSequence
+except ImportError:
+    Image = None
+
+
+def random_rows(width, height, seed, colors=None):
+    """Rows of random pixels, drawn from colors if given."""
+    rng = random.Random(seed)
+    if colors is not None:
+        return [[rng.choice(colors) for _ in range(width)] for _ in range(height)]
+    return [[(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(width)]
+            for _ in range(height)]
+
+
+def rgb_pixels(image):
+    """Decoded pixels of a Pillow image as a flat list of (R, G, B) tuples."""
+    data = image.convert('RGB').tobytes()
+    return list(zip(data[0::3], data[1::3], data[2::3]))
+
+
+def bmp_pixels(data):
+    """Decoded pixels of BMP file contents as a flat list, in file row order."""
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'out.bmp')
+        with open(filename, 'wb') as f:
+            f.write(data)
+        stream = read_bmp_stream(filename)
+        next(stream)
+        return [tuple(pixel) for row in stream for pixel in row]
+    finally:
+        shutil.rmtree(directory)
+
+
+def save_bmp(filename, rows, top_down=False):
+    with open(filename, 'wb') as f:
+        write_24bit_bmp(f, iter(rows), len(rows[0]), len(rows), top_down)
+
+
+def gif_frames(data):
+    """
+    Decode every frame of a GIF to a flat pixel list, composited in order.
+
+    Pillow keeps decoding frames in 'L' mode once the global palette is the
+    identity gray one, ignoring local color tables, so this follows the GIF
+    spec directly. Only what write_animated_gif emits is handled.
+    """
+    width, height, flags = data[6] | data[7] << 8, data[8] | data[9] << 8, data[10]
+    pos = 13
+    global_palette = None
+    if flags & 0x80:
+        size = 3 << ((flags & 7) + 1)
+        global_palette = [tuple(data[i:i + 3]) for i in range(pos, pos + size, 3)]
+        pos += size
+    canvas = [(0, 0, 0)] * (width * height)
+    frames = []
+    while data[pos] != 0x3B:
+        if data[pos] == 0x21:  # Extension: skip its sub-blocks
+            pos += 2
+            while data[pos]:
+                pos += data[pos] + 1
+            pos += 1
+            continue
+        left, top, w, h = (data[pos + i] | data[pos + i + 1] << 8 for i in (1, 3, 5, 7))
+        flags = data[pos + 9]
+        pos += 10
+        palette = global_palette
+        if flags & 0x80:
+            size = 3 << ((flags & 7) + 1)
+            palette = [tuple(data[i:i + 3]) for i in range(pos, pos + size, 3)]
+            pos += size
+        min_code_size = data[pos]
+        pos += 1
+        compressed = bytearray()
+        while data[pos]:
+            compressed += data[pos + 1:pos + 1 + data[pos]]
+            pos += data[pos] + 1
+        pos += 1
+        for i, index in enumerate(lzw_decode(compressed, min_code_size)[:w * h]):
+            canvas[(top + i // w) * width + left + i % w] = palette[index]
+        frames.append(list(canvas))
+    return frames
+
+
+def lzw_decode(compressed, min_code_size):
+    """Decode GIF LZW data to a list of palette indices."""
+    clear, end = 1 << min_code_size, (1 << min_code_size) + 1
+    value = int.from_bytes(compressed, 'little')
+    bit, out, table, previous = 0, [], None, None
+    code_size = min_code_size + 1
+    while bit + code_size <= len(compressed) * 8:
+        code = (value >> bit) & ((1 << code_size) - 1)
+        bit += code_size
+        if code == clear:
+            table = [[i] for i in range(clear)] + [None, None]
+            code_size, previous = min_code_size + 1, None
+            continue
+        if code == end:
+            break
+        if previous is None:
+            entry = table[code]
+        else:
+            entry = table[code] if code < len(table) else previous + previous[:1]
+            table.append(previous + entry[:1])
+        out.extend(entry)
+        previous = entry
+        if len(table) == 1 << code_size and code_size < 12:
+            code_size += 1
+    return out
+
+
+# Transformations tagged the way the pipeline planner expects
+
+def flip_horizontal(row_generator):
+    yield next(row_generator)
+    for row in row_generator:
+        yield list(row)[::-1]
+
+
+P.set_geometry(flip_horizontal, P.FLIP_HORIZONTAL)
+P.set_raw_block_op(flip_horizontal, P.raw_flip_horizontal)
+
+
+def flip_vertical(row_generator):
+    return reverse_row_stream(row_generator)
+
+
+P.set_geometry(flip_vertical, P.FLIP_VERTICAL)
+
+
+def grayscale(row_generator):
+    yield mark_gray(next(row_generator))
+    for row in row_generator:
+        yield [(int(0.299 * r + 0.587 * g + 0.114 * b),) * 3 for r, g, b in row]
+
+
+grayscale = P.set_pixel_map(grayscale, P.luminance, P.luminance_numpy)
+
+
+def brightness(factor):
+    def adjust(row_generator):
+        yield next(row_generator)
+        for row in row_generator:
+            yield [tuple(min(255, int(value * factor)) for value in pixel) for pixel in row]
+    return P.set_channel_lut(adjust, P.scale_table(factor))
+
+
+def invert(row_generator):
+    yield next(row_generator)
+    for row in row_generator:
+        yield [tuple(255 - value for value in pixel) for pixel in row]
+
+
+invert = P.set_channel_lut(invert, bytes(255 - value for value in range(256)))
+
+
+def crop(row_generator):
+    metadata = dict(next(row_generator))
+    width, height = min(5, metadata['width'] - 1), min(4, metadata['height'] - 1)
+    metadata['width'], metadata['height'] = width, height
+    yield metadata
+    for i, row in enumerate(row_generator):
+        if 1 <= i <= height:
+            yield list(row)[1:1 + width]
+
+
+P.set_geometry(crop, P.SELECTS_PIXELS)
+
+
+def ramp(row_generator):
+    """Untagged, row-dependent stage the planner must leave alone."""
+    yield next(row_generator)
+    for i, row in enumerate(row_generator):
+        yield [(min(255, r + i), g, b) for r, g, b in row]
+
+
+class TestPlannedPipeline(unittest.TestCase):
+    """Test plan_pipeline/execute_planned against running the stages directly"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.inputs = []
+        for top_down in (False, True):
+            filename = os.path.join(cls.directory, 'in_%d.bmp' % top_down)
+            save_bmp(filename, random_rows(13, 7, seed=top_down), top_down)
+            cls.inputs.append(filename)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def memory_writer(self, honors_top_down):
+        """Writer keeping metadata and rows top-to-bottom in a dictionary."""
+        out = {}
+
+        def writer(row_generator):
+            metadata = dict(next(row_generator))
+            rows = [list(row) for row in row_generator]
+            if not metadata.pop('top_down', False):
+                rows.reverse()
+            out['result'] = (metadata, rows)
+
+        P.describe_writer(writer, 'memory', honors_top_down=honors_top_down)
+        return writer, out
+
+    def run_directly(self, filename, transformations):
+        writer, out = self.memory_writer(False)
+        stream = read_bmp_stream(filename)
+        for transform in transformations:
+            stream = transform(stream)
+        writer(stream)
+        return out['result']
+
+    def test_random_pipelines_match_direct_execution(self):
+        pool = [flip_horizontal, flip_vertical, grayscale, brightness(1.3), brightness(0.6),
+                invert, crop, ramp]
+        rng = random.Random(3)
+        for length in range(6):
+            for _ in range(15):
+                transformations = [rng.choice(pool) for _ in range(length)]
+                for filename in self.inputs:
+                    expected = self.run_directly(filename, transformations)
+                    for honors_top_down in (False, True):
+                        writer, out = self.memory_writer(honors_top_down)
+                        P.execute_planned(read_bmp_stream(filename), transformations, writer)
+                        self.assertEqual(out['result'], expected,
+                                         ([t.__name__ for t in transformations], filename,
+                                          honors_top_down))
+
+
+class TestFusedPointOps(unittest.TestCase):
+    """Test fuse_point_ops against running the stages one by one"""
+
+    def run_stages(self, rows, transformations):
+        stream = iter([{'width': len(rows[0]), 'height': len(rows), 'bit_depth': 24}] + rows)
+        for transform in transformations:
+            stream = transform(stream)
+        metadata = next(stream)
+        return metadata, [PackedRow.from_pixels(row) if not isinstance(row, PackedRow) else row
+                          for row in stream]
+
+    def test_fused_runs_match_sequential(self):
+        rows = random_rows(17, 9, seed=7)
+        chains = [[grayscale, brightness(1.3), brightness(0.7)],
+                  [brightness(1.5), grayscale, invert, brightness(0.8)],
+                  [invert, brightness(1.2), grayscale, invert]]
+        saved_np = P.np
+        self.addCleanup(setattr, P, 'np', saved_np)
+        for use_numpy in (True, False):
+            P.np = saved_np if use_numpy else None
+            for transformations in chains:
+                fused = P.fuse_point_ops(transformations)
+                self.assertEqual(len(fused), 1)
+                self.assertEqual(self.run_stages(rows, fused),
+                                 self.run_stages(rows, transformations))
+
+
+class TestRawPassthrough(unittest.TestCase):
+    """Test the raw (undecoded) 24-bit path against the decoded path"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.inputs = []
+        for top_down in (False, True):
+            # 13 pixels wide, so every row carries a padding byte
+            filename = os.path.join(self.directory, 'in_%d.bmp' % top_down)
+            save_bmp(filename, random_rows(13, 7, seed=top_down), top_down)
+            self.inputs.append(filename)
+
+    def test_metadata_reports_orientation(self):
+        for filename, top_down in zip(self.inputs, (False, True)):
+            self.assertIs(next(read_bmp_stream(filename))['top_down'], top_down)
+
+    def test_raw_passthrough_matches_decoded_bytes(self):
+        output = os.path.join(self.directory, 'out.bmp')
+
+        def writer(row_generator):
+            metadata = next(row_generator)
+            with open(output, 'wb') as f:
+                write_24bit_bmp(f, row_generator, metadata['width'], metadata['height'],
+                                metadata.get('top_down', False))
+
+        P.describe_writer(writer, 'bmp', 24, output)
+        for filename in self.inputs:
+            for transformations in ([flip_horizontal], [invert], [flip_horizontal, invert]):
+                self.assertTrue(P.try_raw_passthrough(read_bmp_stream(filename),
+                                                      transformations, writer))
+                with open(output, 'rb') as f:
+                    raw = f.read()
+                stream = read_bmp_stream(filename)
+                for transform in transformations:
+                    stream = transform(stream)
+                writer(stream)
+                with open(output, 'rb') as f:
+                    self.assertEqual(raw, f.read())
+
+
+class TestStreaming8BitWriter(unittest.TestCase):
+    """Test write_8bit_bmp_streaming against the buffered write_8bit_bmp"""
+
+    WIDTH, HEIGHT = 97, 61
+
+    def check_identical(self, rows):
+        for packed in (False, True):
+            buffered = io.BytesIO()
+            write_8bit_bmp(buffered, iter([list(row) for row in rows]), self.WIDTH, self.HEIGHT)
+            streamed = io.BytesIO()
+            source = [PackedRow.from_pixels(row) if packed else list(row) for row in rows]
+            write_8bit_bmp_streaming(streamed, iter(source), self.WIDTH, self.HEIGHT)
+            self.assertEqual(buffered.getvalue(), streamed.getvalue(), packed)
+
+    def test_gray_image(self):
+        rng = random.Random(1)
+        self.check_identical([[(v, v, v) for v in (rng.randrange(256) for _ in range(self.WIDTH))]
+                              for _ in range(self.HEIGHT)])
+
+    def test_few_colors(self):
+        self.check_identical(random_rows(self.WIDTH, self.HEIGHT, seed=2,
+                                         colors=[(1, 2, 3), (4, 5, 6), (200, 0, 0)]))
+
+    def test_many_colors(self):
+        self.check_identical(random_rows(self.WIDTH, self.HEIGHT, seed=3))
+
+
+@unittest.skipIf(Image is None, "Pillow is not installed")
+class TestGifRoundTrip(unittest.TestCase):
+    """Test that Pillow decodes our GIF encoder's output"""
+
+    def palette_colors(self, image):
+        palette = image.getpalette() or [value for i in range(256) for value in (i, i, i)]
+        return [tuple(palette[i:i + 3]) for i in range(0, len(palette), 3)]
+
+    def assert_nearest_colors(self, image, rows, colors=None):
+        """Each decoded pixel must be the palette color nearest the source pixel."""
+        colors = colors or self.palette_colors(image)
+        palette_index = get_palette_index(colors)
+        expected = [colors[palette_index.lookup(pixel)] for row in rows for pixel in row]
+        self.assertEqual(rgb_pixels(image), expected)
+
+    def decode(self, data):
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return image
+
+    def test_streaming_estimated_palette(self):
+        # 128x64 random pixels overflow the 4096-entry LZW table several times
+        rows = random_rows(128, 64, seed=4)
+        for top_down in (False, True):
+            out = io.BytesIO()
+            source = rows if top_down else rows[::-1]
+            write_gif_streaming(out, iter(source), 128, 64, top_down)
+            image = self.decode(out.getvalue())
+            self.assertEqual(image.size, (128, 64))
+            self.assert_nearest_colors(image, rows)
+
+    def test_streaming_fixed_palette(self):
+        palette = [(0, 0, 0), (255, 255, 255), (255, 0, 0)]
+        rows = random_rows(31, 17, seed=5)
+        out = io.BytesIO()
+        write_gif_streaming(out, iter(rows), 31, 17, top_down=True, palette=palette)
+        image = self.decode(out.getvalue())
+        palette_index = get_palette_index(palette)
+        expected = [palette[palette_index.lookup(pixel)] for row in rows for pixel in row]
+        self.assertEqual(rgb_pixels(image), expected)
+
+    def test_streaming_gray(self):
+        rows = [[(v, v, v) for v in range(x, x + 40)] for x in range(20)]
+        out = io.BytesIO()
+        write_gif_streaming(out, iter(rows), 40, 20, top_down=True, grayscale=True)
+        image = self.decode(out.getvalue())
+        self.assertEqual(rgb_pixels(image),
+                         [pixel for row in rows for pixel in row])
+
+    def test_animated_frames(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'frame.bmp')
+        save_bmp(filename, random_rows(24, 16, seed=6))
+        factors = [0.5, 0.7, 0.9, 1.1, 1.1]  # The repeated frame exercises an empty delta
+
+        def frames():
+            for factor in factors:
+                yield brightness(factor)(read_bmp_stream(filename))
+
+        delays = [50, 60, 70, 80, 90]
+        for delta in (True, False):
+            out = io.BytesIO()
+            count = write_animated_gif(out, frames(), delay=delays, loop=0, delta=delta)
+            self.assertEqual(count, len(factors))
+
+            image = Image.open(io.BytesIO(out.getvalue()))
+            self.assertEqual(image.n_frames, len(factors))
+            self.assertEqual(image.info.get('loop'), 0)
+            colors = self.palette_colors(image)  # Later frames decode as RGB
+            for frame, source, delay in zip(ImageSequence.Iterator(image), frames(), delays):
+                self.assertEqual(frame.info.get('duration'), delay)
+                next(source)
+                self.assert_nearest_colors(frame, [list(row) for row in source][::-1], colors)
+
+
+class TestSampledPalette(unittest.TestCase):
+    """Test that sample_rate never loses colors an exact palette could keep"""
+
+    def test_few_colors_stay_exact(self):
+        rows = [[(10, 0, 0), (12, 0, 0), (0, 0, 200)]] * 4
+        expected = [pixel for row in rows for pixel in row][::-1]
+        for writer in (write_8bit_bmp, write_8bit_bmp_streaming):
+            for sample_rate in (1.0, 0.1):
+                out = io.BytesIO()
+                writer(out, iter(rows), 3, 4, top_down=True, sample_rate=sample_rate)
+                self.assertEqual(sorted(bmp_pixels(out.getvalue())), sorted(expected),
+                                 (writer.__name__, sample_rate))
+
+    def test_many_colors_still_sampled(self):
+        rows = random_rows(40, 30, seed=8)
+        exact, sampled = io.BytesIO(), io.BytesIO()
+        write_8bit_bmp(exact, iter(rows), 40, 30)
+        write_8bit_bmp(sampled, iter(rows), 40, 30, sample_rate=0.25)
+        self.assertNotEqual(exact.getvalue(), sampled.getvalue())
+
+
+class TestSampledQuantizer(unittest.TestCase):
+    """Test that a chosen quantizer backend is used with sample_rate"""
+
+    def test_quantizer_runs_on_the_sample(self):
+        rows = random_rows(40, 30, seed=9)
+        calls = []
+
+        def two_colors(sample_rows, num_colors):
+            calls.append(sum(len(row) for row in sample_rows))
+            return [(0, 0, 0), (255, 255, 255)], None
+
+        out = io.BytesIO()
+        write_8bit_bmp(out, iter(rows), 40, 30, sample_rate=0.25, quantizer=two_colors)
+        self.assertEqual(len(calls), 1)
+        self.assertLess(calls[0], 40 * 30 // 2)  # Only the sample is quantized
+        pixel_data = out.getvalue()[14 + 40 + 256 * 4:]
+        self.assertLessEqual(set(pixel_data), {0, 1})
+
+    def test_backends_differ_with_sample_rate(self):
+        rows = random_rows(40, 30, seed=10)
+        outputs = []
+        for quantizer in (None, 'octree'):
+            out = io.BytesIO()
+            write_8bit_bmp(out, iter(rows), 40, 30, sample_rate=0.25, quantizer=quantizer)
+            outputs.append(out.getvalue())
+        self.assertNotEqual(outputs[0], outputs[1])
+
+
+TRANSFORM_SOURCE = '''
+class Tint:
+    def apply(self, value):
+        return min(255, value * GAIN)
+
+def tinted(row_generator):
+    yield next(row_generator)
+    tint = Tint()
+    for row in row_generator:
+        yield [tuple(tint.apply(c) for c in pixel) for pixel in row]
+'''
+
+
+class TestTransformFingerprint(unittest.TestCase):
+    """Keys must change whenever anything a transformation reads changes."""
+
+    def build(self, source=TRANSFORM_SOURCE, **module_globals):
+        namespace = dict(module_globals, __name__='transforms')
+        exec(source, namespace)
+        return namespace['tinted']
+
+    def test_stable_across_rebuilds(self):
+        self.assertEqual(transform_fingerprint(self.build(GAIN=2)),
+                         transform_fingerprint(self.build(GAIN=2)))
+
+    def test_module_constant_changes_key(self):
+        self.assertNotEqual(transform_fingerprint(self.build(GAIN=2)),
+                            transform_fingerprint(self.build(GAIN=3)))
+
+    def test_lookup_table_changes_key(self):
+        source = TRANSFORM_SOURCE.replace('value * GAIN', 'LUT[value]')
+        self.assertNotEqual(transform_fingerprint(self.build(source, LUT=bytes(range(256)))),
+                            transform_fingerprint(self.build(source, LUT=bytes(255 - v for v in range(256)))))
+
+    def test_class_method_changes_key(self):
+        source = TRANSFORM_SOURCE.replace('min(255, value * GAIN)', 'max(0, value - GAIN)')
+        self.assertNotEqual(transform_fingerprint(self.build(GAIN=2)),
+                            transform_fingerprint(self.build(source, GAIN=2)))
+
+    def test_address_repr_raises(self):
+        with self.assertRaises(TypeError):
+            transform_fingerprint(self.build(GAIN=object()))
+
+    def test_stage_cache_skips_unkeyable_stages(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'in.bmp')
+        save_bmp(filename, random_rows(6, 5, seed=21))
+        token = object()  # Only identified by its address, so never keyed
+
+        def tinted(row_generator):
+            assert token is not None
+            return self.build(GAIN=2)(row_generator)
+
+        cache = StageCache()
+        outputs = []
+        for _ in range(2):
+            cache.run(filename, [invert, tinted], lambda rows: outputs.append(list(rows)[1:]))
+        self.assertEqual((cache.hits, cache.stages_recorded), (1, 2))  # Decoded and inverted
+        expected = list(tinted(invert(read_bmp_stream(filename))))[1:]
+        self.assertEqual(outputs, [expected, expected])
+
+
+# A gray image whose first row is black, so only later rows show color
+GRAY_ROWS = [[(0, 0, 0)] * 4,
+             [(200, 200, 200), (100, 100, 100), (0, 0, 0), (200, 200, 200)],
+             [(100, 100, 100)] * 4]
+
+
+def gray_source():
+    yield mark_gray({'width': 4, 'height': 3, 'top_down': True})
+    for row in GRAY_ROWS:
+        yield list(row)
+
+
+def sepia(row_generator):
+    """Untagged stage that adds color but passes the gray hint through."""
+    yield next(row_generator)
+    for row in row_generator:
+        yield [(r, r * 4 // 5, r * 3 // 5) for r, g, b in row]
+
+
+SEPIA_PIXELS = [(r, r * 4 // 5, r * 3 // 5) for row in GRAY_ROWS for r, g, b in row]
+
+
+class TestStaleGrayHint(unittest.TestCase):
+    """Test that writers check every row of a stream marked gray"""
+
+    def test_bmp_writers(self):
+        for writer in (write_8bit_bmp, write_8bit_bmp_streaming):
+            stream = sepia(gray_source())
+            self.assertTrue(gray_hint(next(stream)))
+            out = io.BytesIO()
+            writer(out, stream, 4, 3, top_down=True, grayscale=True)
+            self.assertEqual(bmp_pixels(out.getvalue()), SEPIA_PIXELS, writer.__name__)
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_gif_writers(self):
+        stream = sepia(gray_source())
+        next(stream)
+        out = io.BytesIO()
+        write_gif_streaming(out, stream, 4, 3, top_down=True, grayscale=True)
+        self.assertEqual(rgb_pixels(Image.open(out)), SEPIA_PIXELS)
+
+        stream = sepia(gray_source())
+        next(stream)
+        image = convert_to_gif(stream, 4, 3, top_down=True, grayscale=True)
+        self.assertEqual(rgb_pixels(image), SEPIA_PIXELS)
+
+    def test_animated_gif(self):
+        gray_pixels = [pixel for row in GRAY_ROWS for pixel in row]
+        cases = [
+            (lambda: [sepia(gray_source())], [SEPIA_PIXELS]),
+            (lambda: [gray_source(), sepia(gray_source()), gray_source()],
+             [gray_pixels, SEPIA_PIXELS, gray_pixels]),
+        ]
+        for frames, expected in cases:
+            for delta in (True, False):
+                out = io.BytesIO()
+                write_animated_gif(out, frames(), top_down=True, delta=delta)
+                self.assertEqual(gif_frames(out.getvalue()), expected)
+
+
+class TestBatchErrors(unittest.TestCase):
+    """Test that errors are kept per job when inputs repeat"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.inputs = []
+        for n, size in enumerate((10, 25)):
+            filename = os.path.join(self.directory, 'in%d.bin' % n)
+            with open(filename, 'wb') as f:
+                f.write(bytes(size))
+            self.inputs.append(filename)
+
+    def failing(self, message):
+        def writer(input_filename):
+            raise ValueError(message)
+        return writer
+
+    def test_errors_per_job(self):
+        first, second = self.inputs
+        jobs = [(first, self.failing('bmp')), (first, self.failing('gif')),
+                (first, len), (second, len), (second, len)]
+        for use_processes in (False, True):
+            result = process_batch(lambda name, writer: writer(name), jobs, workers=2,
+                                   use_processes=use_processes)
+            self.assertEqual(sorted(result.errors), [0, 1])
+            self.assertEqual([(name, str(exc)) for name, exc in
+                              (result.errors[0], result.errors[1])],
+                             [(first, 'bmp'), (first, 'gif')])
+            self.assertEqual(sorted(result.succeeded), [first, second, second])
+            self.assertEqual(result.input_bytes, 35)  # Each input counted once
+
+
+class TestPrefetch(unittest.TestCase):
+    """Test that prefetch stops its reader and passes errors on"""
+
+    def test_early_close_stops_source(self):
+        produced = []
+        closed = threading.Event()
+
+        def source():
+            try:
+                yield {'width': 1, 'height': 10 ** 9}
+                while True:
+                    produced.append(None)
+                    yield [(len(produced) % 256, 0, 0)]
+            finally:
+                closed.set()
+
+        threads = threading.active_count()
+        generator = source()  # Held, so only prefetch can close it
+        rows = prefetch(generator, depth=4)
+        self.assertEqual(next(rows)['width'], 1)
+        self.assertEqual(next(rows), [(1, 0, 0)])
+        rows.close()
+        self.assertTrue(closed.is_set())
+        self.assertEqual(threading.active_count(), threads)
+        # depth rows queued, one waiting to be queued, one read before the stop check
+        self.assertLessEqual(len(produced), 1 + 4 + 2)
+
+    def test_source_error_is_raised(self):
+        def source():
+            yield {'width': 1, 'height': 2}
+            yield [(1, 2, 3)]
+            raise ValueError('truncated file')
+
+        rows = prefetch(source())
+        self.assertEqual(next(rows), {'width': 1, 'height': 2})
+        self.assertEqual(next(rows), [(1, 2, 3)])
+        with self.assertRaisesRegex(ValueError, 'truncated file'):
+            next(rows)
+
+
+class TestPaletteIndex(unittest.TestCase):
+    """Test that the cell index finds the same color as a linear scan"""
+
+    def test_matches_linear_scan(self):
+        rng = random.Random(11)
+        for size in (1, 7, 253):
+            palette = [tuple(rng.randrange(256) for _ in range(3)) for _ in range(size)]
+            palette += palette[:3]  # Duplicates: the lowest index must win
+            palette_index = get_palette_index(palette)
+            pixels = [tuple(rng.randrange(256) for _ in range(3)) for _ in range(2000)]
+            pixels += [(0, 0, 0), (255, 255, 255)] + palette
+            expected = [min(range(len(palette)),
+                            key=lambda i: (sum((a - b) ** 2 for a, b in zip(pixel, palette[i])), i))
+                        for pixel in pixels]
+            self.assertEqual([palette_index.lookup(pixel) for pixel in pixels], expected)
+            self.assertEqual(palette_index.map_row(PackedRow.from_pixels(pixels)), expected)
+
+
+class TestParallel(unittest.TestCase):
+    """Test that band-parallel execution matches a serial run"""
+
+    def test_matches_serial(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for top_down in (False, True):
+            filename = os.path.join(directory, 'in.bmp')
+            save_bmp(filename, random_rows(7, 23, seed=12), top_down)
+            for transformations in ([flip_horizontal, brightness(1.3), flip_vertical],
+                                    [grayscale, flip_vertical, invert],
+                                    [invert, ramp]):  # Unmarked: runs serially
+                def collect(row_generator):
+                    metadata = next(row_generator)
+                    return metadata['width'], metadata['height'], [list(row) for row in row_generator]
+
+                stream = read_bmp_stream(filename)
+                for transform in transformations:
+                    stream = transform(stream)
+                expected = collect(stream)
+                for workers in (1, 3):
+                    self.assertEqual(execute_parallel(filename, transformations, collect,
+                                                      workers=workers, band_rows=4), expected)
+
+
+class TestChunkedPipeline(unittest.TestCase):
+    """Test that running stages on chunks of rows changes nothing"""
+
+    def source(self, packed):
+        rows = random_rows(6, 11, seed=13)
+        yield {'width': 6, 'height': 11}
+        for row in rows:
+            yield PackedRow.from_pixels(row) if packed else row
+
+    def test_matches_row_pipeline(self):
+        for transformations in ([grayscale, flip_horizontal, brightness(1.4)],
+                                [invert, ramp, flip_vertical, brightness(0.6)]):
+            for packed in (False, True):
+                expected = self.source(packed)
+                for transform in transformations:
+                    expected = transform(expected)
+                expected = [list(row) for row in expected][1:]
+                for chunk_size in (1, 4, 64):
+                    stream = chunked_pipeline(transformations, chunk_size)(self.source(packed))
+                    metadata = next(stream)
+                    self.assertEqual((metadata['width'], metadata['height']), (6, 11))
+                    self.assertEqual([list(row) for row in stream], expected)
+
+    def test_chunk_round_trip(self):
+        chunks = list(chunk_rows(self.source(False), 4))
+        self.assertEqual([len(chunk) for chunk in chunks[1:]], [4, 4, 3])
+        self.assertEqual(list(unchunk_rows(iter(chunks))), list(self.source(False)))
+
+
+class TestSharedPalette(unittest.TestCase):
+    """Test building, saving and reusing one palette for a batch"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_save_and_load(self):
+        filename = os.path.join(self.directory, 'batch.pal')
+        palette = [(0, 0, 0), (255, 128, 7), (12, 34, 56)]
+        save_palette(palette, filename)
+        self.assertEqual(load_palette(filename), palette)
+
+        for contents in ('RIFF\n0100\n1\n0 0 0\n', 'JASC-PAL\n0100\n2\n0 0 0\n',
+                         'JASC-PAL\n0100\n1\n0 0 256\n', 'JASC-PAL\n0100\n1\n0 x 0\n'):
+            with open(filename, 'w') as f:
+                f.write(contents)
+            with self.assertRaises(ValueError, msg=contents):
+                load_palette(filename)
+
+    def test_batch_shares_palette(self):
+        colors = [(250, 0, 0), (0, 250, 0), (0, 0, 250), (20, 20, 20)]
+        names = []
+        for seed in (14, 15):
+            names.append(os.path.join(self.directory, 'in%d.bmp' % seed))
+            save_bmp(names[-1], random_rows(9, 8, seed, colors))
+        palette = build_shared_palette(names)
+        self.assertEqual(sorted(palette), sorted(colors))
+
+        for name in names:
+            stream = read_bmp_stream(name)
+            next(stream)
+            rows = [list(row) for row in stream]
+            for writer in (write_8bit_bmp, write_8bit_bmp_streaming):
+                out = io.BytesIO()
+                writer(out, iter(rows), 9, 8, palette=palette)
+                self.assertEqual(bmp_pixels(out.getvalue()),
+                                 [pixel for row in rows for pixel in row])
+
+
+class TestFanOut(unittest.TestCase):
+    """Test that one stream feeds every writer and errors come back"""
+
+    def count(self, row_generator):
+        return sum(1 for _ in row_generator)
+
+    def test_every_writer_gets_the_stream(self):
+        def source():
+            yield {'width': 3, 'height': 70}
+            yield from random_rows(3, 70, seed=16)
+
+        def collect(row_generator):
+            return [list(row) for row in row_generator]
+
+        expected = collect(source())
+        self.assertEqual(fan_out(source(), [collect, collect, self.count], max_queued_rows=4),
+                         [expected, expected, 71])
+
+    def test_writer_error_is_raised(self):
+        def failing(row_generator):
+            next(row_generator)
+            raise OSError('disk full')
+
+        def source():
+            yield {'width': 1, 'height': 100}
+            for value in range(100):
+                yield [(value, value, value)]
+
+        with self.assertRaisesRegex(OSError, 'disk full'):
+            fan_out(source(), [self.count, failing], max_queued_rows=2)
+
+
+def reference_pixel(row_data, x, bit_depth, color_table):
+    """Decode one pixel straight from the BMP spec, one field at a time."""
+    if bit_depth == 1:
+        return color_table[(row_data[x // 8] >> (7 - x % 8)) & 1]
+    if bit_depth == 4:
+        return color_table[(row_data[x // 2] >> (4 if x % 2 == 0 else 0)) & 0x0F]
+    if bit_depth == 8:
+        return color_table[row_data[x]]
+    if bit_depth == 16:
+        word = row_data[2 * x] | row_data[2 * x + 1] << 8
+        return ((word >> 10) & 0x1F) << 3, ((word >> 5) & 0x1F) << 3, (word & 0x1F) << 3
+    size = bit_depth // 8
+    b, g, r = row_data[size * x:size * x + 3]
+    return r, g, b
+
+
+class TestRowDecoding(unittest.TestCase):
+    """Test bulk row decoding against a per-pixel reference"""
+
+    def test_every_bit_depth(self):
+        rng = random.Random(17)
+        for bit_depth in (1, 4, 8, 16, 24, 32):
+            color_table = None
+            if bit_depth <= 8:
+                color_table = [tuple(rng.randrange(256) for _ in range(3))
+                               for _ in range(1 << bit_depth)]
+            for width in (1, 5, 13):
+                row_size = ((width * bit_depth + 31) // 32) * 4
+                block = bytes(rng.randrange(256) for _ in range(row_size * 6))
+                expected = [[reference_pixel(block[y * row_size:], x, bit_depth, color_table)
+                             for x in range(width)] for y in range(6)]
+                for packed in (False, True):
+                    rows = parse_rows(block, width, bit_depth, color_table, row_size, packed)
+                    self.assertEqual([list(row) for row in rows], expected, (bit_depth, width))
+                    with mock.patch('img_utils.bmp_reader_utils.np', None):
+                        rows = parse_rows(block, width, bit_depth, color_table, row_size, packed)
+                    self.assertEqual([list(row) for row in rows], expected)
+                    self.assertEqual([list(parse_row(block[y * row_size:(y + 1) * row_size],
+                                                     width, bit_depth, color_table, packed))
+                                      for y in range(6)], expected)
+
+
+class TestMappedReader(unittest.TestCase):
+    """Test random access through the memory-mapped reader"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.rows = random_rows(9, 7, seed=18)
+        self.filename = os.path.join(directory, 'in.bmp')
+        save_bmp(self.filename, self.rows)
+
+    def test_rows_match_stream(self):
+        stream = read_bmp_stream(self.filename)
+        next(stream)
+        file_order = [list(row) for row in stream]
+        with MappedBMPReader(self.filename) as bmp:
+            self.assertEqual(len(bmp), 7)
+            self.assertEqual(list(bmp.read_rows()), file_order)
+            self.assertEqual(list(bmp.read_rows(reverse=True)), file_order[::-1])
+            self.assertEqual(bmp.parse(bmp.row(-1)), file_order[-1])
+
+    def test_window(self):
+        with MappedBMPReader(self.filename) as bmp:
+            self.assertEqual(list(bmp.read_window(2, 3, 4, 3)),
+                             [row[2:6] for row in self.rows[3:6]])
+            with self.assertRaises(ValueError):
+                bmp.window(6, 0, 4, 1)
+            with self.assertRaises(IndexError):
+                bmp.row(7)
+
+
+class TestStageCache(unittest.TestCase):
+    """Test that runs sharing a prefix resume from the recorded stage"""
+
+    def test_prefix_reuse(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'in.bmp')
+        save_bmp(filename, random_rows(9, 7, seed=19))
+
+        def collect(row_generator):
+            next(row_generator)
+            return [list(row) for row in row_generator]
+
+        runs = [[invert, brightness(1.3)], [invert, flip_vertical], [invert, brightness(1.3)],
+                [invert, brightness(1.3), flip_horizontal]]
+        expected = []
+        for transformations in runs:
+            stream = read_bmp_stream(filename)
+            for transform in transformations:
+                stream = transform(stream)
+            expected.append(collect(stream))
+
+        for max_memory_bytes in (1 << 20, 100):  # 100 bytes spills every stage
+            spill_directory = os.path.join(directory, 'spill%d' % max_memory_bytes)
+            os.mkdir(spill_directory)
+            cache = StageCache(max_memory_bytes, spill_directory=spill_directory)
+            self.assertEqual([cache.run(filename, transformations, collect)
+                              for transformations in runs], expected)
+            self.assertEqual((cache.hits, cache.misses), (3, 1))
+            self.assertEqual(cache.stats()['stages'], 5)  # Decoded, invert and three outputs
+            self.assertEqual(bool(os.listdir(spill_directory)), max_memory_bytes == 100)
+            cache.clear()
+            self.assertEqual(os.listdir(spill_directory), [])
+
+
+class TestAsyncPipeline(unittest.TestCase):
+    """Test that the asyncio API yields what the synchronous pipeline does"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.filename = os.path.join(directory, 'in.bmp')
+        save_bmp(self.filename, random_rows(5, 8, seed=20))
+        stream = flip_vertical(grayscale(read_bmp_stream(self.filename)))
+        self.expected = [next(stream)['width']] + [list(row) for row in stream]
+
+    def collect(self, row_generator):
+        return [next(row_generator)['width']] + [list(row) for row in row_generator]
+
+    def test_stream_and_write(self):
+        async def run():
+            pipeline = lambda stream: atransform(flip_vertical)(atransform(grayscale)(stream))
+            items = [item async for item in pipeline(await aread_bmp(self.filename, batch_rows=3))]
+            written = await awrite(self.collect,
+                                   pipeline(await aread_bmp(self.filename, batch_rows=3)))
+            return items, written
+
+        items, written = asyncio.run(run())
+        self.assertEqual([items[0]['width']] + [list(row) for row in items[1:]], self.expected)
+        self.assertEqual(written, self.expected)
+
+    def test_run_pipeline(self):
+        async def run():
+            return await asyncio.gather(*(arun_pipeline(self.filename, [grayscale, flip_vertical],
+                                                        self.collect) for _ in range(3)))
+
+        self.assertEqual(asyncio.run(run()), [self.expected] * 3)
+
+    def test_started_stream_is_rejected(self):
+        async def run():
+            stream = await aread_bmp(self.filename)
+            await stream.__anext__()
+            try:
+                atransform(grayscale)(stream)
+            finally:
+                await stream.aclose()
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(run())
+
+
+class TestReverseRows(unittest.TestCase):
+    """Test that rows come back reversed from files and from any generator"""
+
+    @mock.patch('img_utils.bmp_reader_utils.ROW_BLOCK_BYTES', 16 * 7)
+    def test_reverse(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        rows = random_rows(5, 300, seed=22)  # 7 rows per read block
+        filename = os.path.join(directory, 'in.bmp')
+        for top_down in (False, True):
+            save_bmp(filename, rows, top_down)
+            stream = reverse_row_stream(read_bmp_stream(filename))
+            self.assertEqual(next(stream)['height'], 300)
+            self.assertEqual([list(row) for row in stream], rows[::-1])
+
+        for packed in (False, True):
+            source = iter([{'width': 5, 'height': 300}]
+                          + [PackedRow.from_pixels(row) if packed else row for row in rows])
+            stream = reverse_row_stream(source)
+            next(stream)
+            self.assertEqual([list(row) for row in stream], rows[::-1])
+
+
+class TestPackedRow(unittest.TestCase):
+    """Test that PackedRow behaves like the list of tuples it stores"""
+
+    def setUp(self):
+        self.pixels = random_rows(11, 1, seed=23)[0]
+        self.row = PackedRow.from_pixels(self.pixels)
+
+    def test_sequence(self):
+        self.assertEqual(len(self.row), 11)
+        self.assertEqual(list(self.row), self.pixels)
+        self.assertEqual(list(reversed(self.row)), self.pixels[::-1])
+        self.assertEqual(self.row, self.pixels)
+        for index in (0, 5, -1):
+            self.assertEqual(self.row[index], self.pixels[index])
+        for piece in (slice(2, 7), slice(None, None, 2), slice(8, 3), slice(None, None, -1)):
+            self.assertEqual(list(self.row[piece]), self.pixels[piece])
+        with self.assertRaises(IndexError):
+            self.row[11]
+        self.row[3] = (1, 2, 3)
+        self.assertEqual(self.row[3], (1, 2, 3))
+
+    def test_conversions(self):
+        bgr = bytes(value for r, g, b in self.pixels for value in (b, g, r))
+        self.assertEqual(self.row.to_bgr(), bgr)
+        self.assertEqual(PackedRow.from_bgr(bgr), self.row)
+        self.assertEqual(self.row.flipped(), self.pixels[::-1])
+        self.assertEqual(self.row.to_pixels(), self.pixels)
+
+    def test_pixel_maps(self):
+        table = bytes(255 - value for value in range(256))
+        self.assertEqual(self.row.translate(table),
+                         [tuple(255 - value for value in pixel) for pixel in self.pixels])
+        zero, same = bytes(256), bytes(range(256))
+        self.assertEqual(self.row.map_channels(zero, same, table),
+                         [(0, g, 255 - b) for r, g, b in self.pixels])
+        self.assertEqual(self.row.grayscale(),
+                         [(int(0.299 * r + 0.587 * g + 0.114 * b),) * 3 for r, g, b in self.pixels])
+
+
+class TestMedianCut(unittest.TestCase):
+    """Test the histogram median cut on images with known answers"""
+
+    def quantize(self, rows, num_colors):
+        palette, pixel_indices = get_quantizer('median_cut')(rows, num_colors)
+        self.assertEqual(len(palette), 256)
+        return [palette[index] for index_row in pixel_indices for index in index_row]
+
+    def test_few_colors_stay_exact(self):
+        colors = [(3, 43, 83), (203, 3, 123), (83, 163, 243), (243, 243, 3), (123, 83, 43)]
+        rows = random_rows(20, 10, seed=24, colors=colors)
+        self.assertEqual(self.quantize(rows, 256), [pixel for row in rows for pixel in row])
+
+    def test_clusters(self):
+        rng = random.Random(25)
+        centers = [(r, g, b) for r in (40, 200) for g in (40, 200) for b in (40, 200)]
+        rows = [[tuple(channel + rng.randint(-3, 3) for channel in rng.choice(centers))
+                 for _ in range(60)] for _ in range(40)]
+        pixels = [pixel for row in rows for pixel in row]
+        quantized = self.quantize(rows, 8)
+        error = sum((a - b) ** 2 for pixel, color in zip(pixels, quantized)
+                    for a, b in zip(pixel, color)) / len(pixels)
+        self.assertLess(error, 3 * 4 * 2)  # Noise alone averages 3 * 4 per pixel
+
+
+class CountingBytesIO(io.BytesIO):
+    """BytesIO that counts write calls."""
+
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return super().write(data)
+
+
+class TestBufferedWrites(unittest.TestCase):
+    """Test that BMP writers batch their writes without changing the bytes"""
+
+    def test_coalesced_writes(self):
+        rows = random_rows(10, 30, seed=26)  # 32-byte padded rows
+        for top_down in (False, True):
+            outputs = []
+            for buffer_size, writes in ((None, 2), (100, 1 + 8), (1, 1 + 30)):
+                out = CountingBytesIO()
+                write_24bit_bmp(out, iter(rows), 10, 30, top_down, buffer_size=buffer_size)
+                self.assertEqual(out.writes, writes, buffer_size)
+                outputs.append(out.getvalue())
+            self.assertEqual(len(set(outputs)), 1)
+
+            data = outputs[0]
+            self.assertEqual(data[:2], b'BM')
+            self.assertEqual(int.from_bytes(data[2:6], 'little'), len(data))
+            self.assertEqual(int.from_bytes(data[22:26], 'little', signed=True),
+                             -30 if top_down else 30)
+            self.assertEqual(bmp_pixels(data), [pixel for row in rows for pixel in row])
+
+    def test_8bit_header_and_palette_in_one_write(self):
+        rows = random_rows(10, 30, seed=27, colors=[(1, 2, 3), (200, 100, 0)])
+        out = CountingBytesIO()
+        write_8bit_bmp(out, iter(rows), 10, 30)
+        self.assertEqual(out.writes, 2)
+        self.assertEqual(bmp_pixels(out.getvalue()), [pixel for row in rows for pixel in row])
+
+
+if __name__ == '__main__':
+    unittest.main()
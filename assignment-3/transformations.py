@@ -18,6 +18,10 @@ def flip_vertical(row_generator):
     """
     Flip image vertically (mirror top-bottom).
     
+    Note: Rows must come out in reverse order. Rather than buffering the
+    whole image, img_utils.stream_utils.reverse_row_stream can read them
+    backwards from the source file or spill them to a temporary file.
+    
     Args:
         row_generator: Generator yielding metadata, then rows
     """
@@ -29,6 +33,11 @@ def grayscale(row_generator):
     Convert RGB image to grayscale using luminance formula.
     Formula: 0.299*R + 0.587*G + 0.114*B
     
+    Note: Yielding img_utils.row_utils.mark_gray(metadata) tells the writers
+    the output is gray, so they skip scanning it for color. Declaring it with
+    img_utils.pipeline_utils.set_pixel_map(grayscale, luminance,
+    luminance_numpy) lets the pipeline fuse it with brightness.
+    
     Args:
         row_generator: Generator yielding metadata, then rows
     """
@@ -39,6 +48,10 @@ def brightness(factor):
     """
     Adjust brightness of all pixels by multiplication factor.
     
+    Note: Declaring the returned transformation with
+    img_utils.pipeline_utils.set_channel_lut(transform, scale_table(factor))
+    lets the pipeline fuse it with neighbouring point operations.
+    
     Args:
         factor: Brightness multiplier (1.0 = no change, >1.0 = brighter, <1.0 = darker)
     """